@@ -1,59 +1,272 @@
-from sklearn.cluster import KMeans
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-import seaborn as sns
+import os
+
+from joblib import Parallel, delayed
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score, calinski_harabasz_score
+import numpy as np
 import pandas as pd
 
+# matplotlib and seaborn are imported by the plotting functions so model selection runs headless without them
+
+# above this many rows select_k fits MiniBatchKMeans unless told otherwise
+MINIBATCH_ROWS = 100000
+
+
+def _target_array(df, target_cols):
+    cols = [target_cols] if isinstance(target_cols, str) else list(target_cols)
+    return df[cols].to_numpy(dtype='float64')
+
+
+def _kmeans(k, minibatch, init='k-means++', n_init=10, max_iter=300, random_state=0):
+    if minibatch:
+        return MiniBatchKMeans(n_clusters=k, init=init, n_init=n_init, max_iter=max_iter, batch_size=4096,
+                               random_state=random_state)
+    return KMeans(n_clusters=k, init=init, n_init=n_init, max_iter=max_iter, random_state=random_state)
+
 
-def find_best_k(df, target_cols, suffix, max_k=10):
+def _evaluate(k, model, sample):
+    labels = model.predict(sample)
+    scores = {'k': k, 'inertia': model.inertia_, 'n_iter': model.n_iter_,
+              'silhouette': np.nan, 'calinski_harabasz': np.nan}
+    # both scores are undefined for a single cluster or a cluster per row
+    if 1 < len(np.unique(labels)) < len(sample):
+        scores['silhouette'] = silhouette_score(sample, labels)
+        scores['calinski_harabasz'] = calinski_harabasz_score(sample, labels)
+    return scores
+
+
+def _fit_and_evaluate(k, data, sample, minibatch, max_iter, random_state):
+    model = _kmeans(k, minibatch, max_iter=max_iter, random_state=random_state).fit(data)
+    return _evaluate(k, model, sample)
+
+
+def _grow_centroids(sample, centroids, k, rng):
+    # k-means++ seeding continued from existing centroids: every new centroid is a sample row drawn with
+    # probability proportional to its squared distance from the closest centroid so far
+    centroids = list(centroids)
+    if not centroids:
+        # the first k has nothing to continue from, its first centroid is drawn uniformly as in k-means++
+        centroids.append(sample[rng.choice(len(sample))])
+    while len(centroids) < k:
+        d2 = ((sample[:, None, :] - np.array(centroids)[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+        p = d2 / d2.sum() if d2.sum() > 0 else None
+        centroids.append(sample[rng.choice(len(sample), p=p)])
+    return np.array(centroids)
+
+
+def select_k(df, target_cols, ks=range(1, 11), minibatch=None, warm_start=False, sample_size=10000, max_iter=300,
+             n_jobs=-1, random_state=0):
     """
-    Runs Kmeans clustering on target columns and outputs sse and data for elbow plotting
+    Fits K-means for every candidate k and scores the fits, nothing is plotted (see plot_k_selection)
+
+    Without warm_start every k is fitted independently (n_init=10) in parallel worker processes.  With warm_start
+    the fits run in order of k, each seeded with the previous k's centroids plus k-means++ draws for the new ones
+    (n_init=1), which converges in fewer iterations on large data; only the scoring runs in parallel.
 
     :param df: pandas DataFrame
-    :param target_col: column or columns to be used for K-means clustering
+    :param target_cols: column or list of columns to be used for K-means clustering
+    :param ks: candidate numbers of clusters
+    :param minibatch: fit MiniBatchKMeans instead of KMeans, defaults to True above MINIBATCH_ROWS rows
+    :param warm_start: seed each k with the centroids of the previous k
+    :param sample_size: number of rows the silhouette and Calinski-Harabasz scores are computed on
+    :param max_iter: maximum iterations per fit
+    :param n_jobs: number of worker processes, -1 for all CPUs
+    :param random_state: seed for the fits and the sample
+    :returns: pandas DataFrame indexed by k with inertia, n_iter, silhouette and calinski_harabasz
+    """
+    data = _target_array(df, target_cols)
+    ks = sorted(ks)
+    if minibatch is None:
+        minibatch = len(data) > MINIBATCH_ROWS
+    rng = np.random.default_rng(random_state)
+    sample = data[rng.choice(len(data), sample_size, replace=False)] if len(data) > sample_size else data
+
+    parallel = Parallel(n_jobs=n_jobs)
+    if warm_start:
+        models, centroids = {}, np.empty((0, data.shape[1]))
+        for k in ks:
+            init = _grow_centroids(sample, centroids[:k], k, rng)
+            models[k] = _kmeans(k, minibatch, init=init, n_init=1, max_iter=max_iter,
+                                random_state=random_state).fit(data)
+            centroids = models[k].cluster_centers_
+        results = parallel(delayed(_evaluate)(k, models[k], sample) for k in ks)
+    else:
+        results = parallel(delayed(_fit_and_evaluate)(k, data, sample, minibatch, max_iter, random_state)
+                           for k in ks)
+    return pd.DataFrame(results).set_index('k')
+
+
+def plot_k_selection(results, suffix, metric='inertia'):
+    """
+    Elbow plot of a select_k metric
+
+    :param results: pandas DataFrame returned by select_k
     :param suffix: Suffix to main title, usually target_col
-    :returns: dict of k:inertia values and a pandas df with new cluster labels
+    :param metric: column of results to plot
+    :returns: matplotlib Figure
     """
-    sse={}
-    data = df[target_cols].values.reshape(-1, 1)
-    for k in range(1, max_k+1):
-        kmeans = KMeans(n_clusters=k, max_iter=1000).fit(data)
-        #data["clusters"] = kmeans.labels_
-        sse[k] = kmeans.inertia_
+    import matplotlib.pyplot as plt
 
     fig = plt.figure(figsize=(24, 10))
-    plot = plt.plot(list(sse.keys()), list(sse.values()))
+    plot = plt.plot(results.index, results[metric])
     xlabel = plt.xlabel("Number of clusters", fontsize=16, fontweight='bold')
-    ylabel = plt.ylabel("Inertia", fontsize=16, fontweight='bold')
+    ylabel = plt.ylabel(metric.replace('_', ' ').title(), fontsize=16, fontweight='bold')
     xticks = plt.xticks(fontsize=16, fontweight='bold')
-    title = plt.title(f'Selecting K-value based on inertia: {suffix}', fontsize=30, fontweight='bold')
+    title = plt.title(f'Selecting K-value based on {metric}: {suffix}', fontsize=30, fontweight='bold')
+    return fig
+
+
+def find_best_k(df, target_cols, suffix, max_k=10, plot=True):
+    """
+    Runs Kmeans clustering on target columns and outputs sse and data for elbow plotting
 
-    return sse
+    :param df: pandas DataFrame
+    :param target_col: column or columns to be used for K-means clustering
+    :param suffix: Suffix to main title, usually target_col
+    :param max_k: largest number of clusters tried
+    :param plot: draw the elbow plot, see plot_k_selection
+    :returns: dict of k:inertia values
+    """
+    results = select_k(df, target_cols, range(1, max_k + 1), max_iter=1000)
+    if plot:
+        plot_k_selection(results, suffix)
+    return results['inertia'].to_dict()
 
-def create_labels(df, target_cols, k):
+def _sq_distances(data, centroids):
+    # squared euclidean distance of every row to every centroid as one matrix product
+    d2 = (data ** 2).sum(axis=1)[:, None] - 2 * data @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+    return np.maximum(d2, 0)
+
+
+class Segmentation:
+    """
+    K-means segmentation that is fitted once and persisted.  Centroids are stored sorted ascending by the target
+    columns, so label 0 is always the lowest segment and labels stay stable across refits.  New or updated patients
+    are assigned to the nearest centroid without refitting.
+    """
+
+    def __init__(self, centroids, target_cols, fitted_at, fit_distance):
+        """
+        :param centroids: array of shape (k, len(target_cols)) in label order
+        :param target_cols: columns the segmentation was fitted on
+        :param fitted_at: pandas Timestamp of the fit
+        :param fit_distance: mean squared distance of the fitted rows to their centroid, the baseline for drift
+        """
+        self.centroids = np.asarray(centroids, dtype='float64')
+        self.target_cols = list(target_cols)
+        self.fitted_at = pd.Timestamp(fitted_at)
+        self.fit_distance = float(fit_distance)
+
+    @classmethod
+    def fit(cls, df, target_cols, k, minibatch=None, max_iter=1000, random_state=0, now=None):
+        """
+        Fits K-means and orders the centroids
+
+        :param df: pandas DataFrame
+        :param target_cols: column or list of columns to be used for K-means clustering
+        :param k: best k found from select_k
+        :param minibatch: fit MiniBatchKMeans instead of KMeans, defaults to True above MINIBATCH_ROWS rows
+        :param max_iter: maximum iterations of the fit
+        :param random_state: seed for the fit
+        :param now: time of the fit, defaults to the current time
+        :return: fitted Segmentation
+        """
+        target_cols = [target_cols] if isinstance(target_cols, str) else list(target_cols)
+        data = _target_array(df, target_cols)
+        if minibatch is None:
+            minibatch = len(data) > MINIBATCH_ROWS
+        centroids = _kmeans(k, minibatch, max_iter=max_iter, random_state=random_state).fit(data).cluster_centers_
+        # sort by the first target column, then the second, ...
+        centroids = centroids[np.lexsort(centroids.T[::-1])]
+        fit_distance = _sq_distances(data, centroids).min(axis=1).mean()
+        return cls(centroids, target_cols, pd.Timestamp.now() if now is None else now, fit_distance)
+
+    def assign(self, df):
+        """
+        Assigns every row to its nearest centroid
+
+        :param df: pandas DataFrame with the target columns
+        :return: array of cluster labels and array of squared distances to the assigned centroid
+        """
+        d2 = _sq_distances(_target_array(df, self.target_cols), self.centroids)
+        labels = d2.argmin(axis=1)
+        return labels, d2[np.arange(len(labels)), labels]
+
+    def drift(self, distances):
+        """
+        Relative change of the mean squared distance to the nearest centroid since the fit
+
+        :param distances: squared distances returned by assign
+        :return: float, 0 when the rows fit the centroids as well as the fitted rows did
+        """
+        return distances.mean() / self.fit_distance - 1 if self.fit_distance else np.inf
+
+    def needs_refit(self, distances, drift_threshold=0.25, max_age_days=90, now=None):
+        """
+        :param distances: squared distances returned by assign
+        :param drift_threshold: refit when drift exceeds this value
+        :param max_age_days: refit when the fit is older than this many days
+        :param now: reference time for the age of the fit, defaults to the current time
+        :return: True if the segmentation is due for a refit
+        """
+        now = pd.Timestamp.now() if now is None else pd.Timestamp(now)
+        return (now - self.fitted_at).days > max_age_days or self.drift(distances) > drift_threshold
+
+    def save(self, path):
+        """
+        Writes the segmentation to an npz file, atomically
+
+        :param path: destination file
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, centroids=self.centroids, target_cols=np.array(self.target_cols),
+                     fitted_at=np.array(self.fitted_at.isoformat()), fit_distance=np.array(self.fit_distance))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: npz file written by save
+        :return: Segmentation
+        """
+        with np.load(path) as stored:
+            return cls(stored['centroids'], stored['target_cols'].tolist(), str(stored['fitted_at']),
+                       stored['fit_distance'])
+
+
+def create_labels(df, target_cols, k, model_path=None, drift_threshold=0.25, max_age_days=90):
     """
     Create clusters labels based on results of Kmeans clustering
-    
+
+    The segmentation is fitted once and saved to model_path.  Later calls load it and assign clusters to the nearest
+    centroid; it is refitted only when it is older than max_age_days or the data has drifted past drift_threshold
+    (see Segmentation.needs_refit), or when it was fitted with a different k or different columns.
+
     :param df: pandas DataFrame
     :param target_cols: column to be used for kmeans calculations, use list if more than one
     :param k: best k found from find_best_k
-    :return: new df with cluster labels
+    :param model_path: npz file the segmentation is persisted to, None to fit without persisting
+    :param drift_threshold: see Segmentation.needs_refit
+    :param max_age_days: see Segmentation.needs_refit
+    :return: describe table of the target columns per cluster and new df with cluster labels
     """
-    
-    if len(target_cols) == 1:
-        data = df[target_cols].values.reshape(-1, 1)
-    else:
-        data = df[target_cols]
-    kmeans = KMeans(n_clusters=k, max_iter=1000).fit(data)
-    df["clusters"] = kmeans.labels_
-
-    df_new = df.groupby('clusters')[target_cols].mean().reset_index()
-    df_new = df_new.sort_values(by=target_cols, ascending=True).reset_index(drop=True)
-    df_new['index'] = df_new.index
-    df_final = pd.merge(df, df_new[['clusters', 'index']], on='clusters')
-    df_final = df_final.drop(['clusters'], axis=1)
-    df_final = df_final.rename(columns={"index": 'clusters'})
+    target_cols = [target_cols] if isinstance(target_cols, str) else list(target_cols)
+    labels = None
+    if model_path is not None and os.path.exists(model_path):
+        segmentation = Segmentation.load(model_path)
+        if len(segmentation.centroids) == k and segmentation.target_cols == target_cols:
+            labels, distances = segmentation.assign(df)
+            if segmentation.needs_refit(distances, drift_threshold, max_age_days):
+                labels = None
+    if labels is None:
+        segmentation = Segmentation.fit(df, target_cols, k)
+        if model_path is not None:
+            segmentation.save(model_path)
+        labels, _ = segmentation.assign(df)
 
+    df_final = df.assign(clusters=labels)
     table = df_final.groupby('clusters')[target_cols].describe()
 
     return table, df_final
@@ -68,6 +281,8 @@ def box_results(df, cat_col, cont_col, title):
     :param title: Main title of plot
     :return: boxplot of results
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
     fig = plt.figure(figsize=(24, 10))
     plot = sns.boxplot(x=df[cat_col], y=df[cont_col], hue=df[cat_col])
@@ -87,6 +302,7 @@ def twoD_viz(df, xcol, ycol):
     :param ycol: column along y-axis
     :return: visualization of plotted results
     """
+    import matplotlib.pyplot as plt
 
     X = df[xcol]
     y = df[ycol]
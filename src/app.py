@@ -1,84 +1,54 @@
 import streamlit as st
-import pandas as pd
-import pickle
-from transform_data import Transform
+from model_functions import load_threshold
+from profiling import profiled
+from refresh import Refresher
+from score import priority_list
+from transform_data import ContactIndex
 
 st.title('Potential Churn Patients')
 
-t = Transform()
-total = t.pay_transform('../data/raw/payment.csv', '../data/raw/claims.csv')
-patient = t.patient_transform('../data/raw/appt.csv', '../data/raw/patient.csv')
-merged = patient.merge(total)
-for_model, contact = t.data_split(merged)
-
-@st.cache
-def load_data(link_data, drop_columns):
+@st.cache(allow_output_mutation=True)
+def refresher():
     """
-    Loads data from source and parses into a test set for predictions
-
-    Parameters:
-        link_data: original dataframe to link patients with after making predictions on churn
-        drop_columns: list of columns to be dropped from raw dataset for use with model predictions
+    Starts the background refresher once per server, every session reads its latest snapshot
 
     Returns:
-        Original dataset to map back to patient contact info and test set to be used for making predictions
+        Running Refresher, see refresh.py
     """
+    return Refresher('../data/raw', 'bestLRmodel.pkl', '../data/scores', '../data/cache').start()
 
-    #link_data = orig_data[orig_data['Recency'].between(start_day, end_day)].reset_index(drop=True)
-    test_data = link_data.drop(drop_columns, axis=1)
-    return link_data, test_data
-
-def load_model(filepath):
+@st.cache(allow_output_mutation=True)
+@profiled()
+def contact_index(contact):
     """
-    Loads Picked model for use with predictions
+    Builds the numeric contact list once per data load, so moving the score sliders only rescores it
 
     Parameters:
-        Filepath to pickled model
+        contact: contact window df from data_split
 
     Returns:
-        Pickled model for use with predictions on data
+        ContactIndex of the contact window
     """
-    
-    with open(filepath, 'rb') as file:
-        Pickled_Model = pickle.load(file)
-    return Pickled_Model
-
-def priority_list(original_df, predicted_probas, thresh=0.48, num_patients=20):
-    """
-    Create patient prioritized contact list to prevent churn
-
-    Parameters:
-        original df:      df to map back to patient contact info
-        predicted_probas: predicted probabilities for each patients to be sorted highest to lowest for churn (must be 2d array for binary class)
-        thresh:           threshold setting for capturing predicted churn above a certain threshold, default = 0.48
-        num_patients:     user input feature to allow setting the number of patients that the receptionist wants to contact each day
-
-    Returns:
-        Prioritized list of potential churn patients for staff to take action on (includes patient contact info)
-    """
-    
-    preds = pd.DataFrame(predicted_probas)
-    churns = preds[preds[1] >= thresh].loc[:,1].sort_values(ascending=False)
-    priority_patients = churns.iloc[:num_patients]
-    indices = priority_patients.index.tolist()
-    patients = original_df.loc[indices, ['PatNum', 'FName', 'Tenure', 'Frequency', 'Recency']]
-    #patients.insert(5, 'Risk Factor', round(priority_patients,1))
-    patients.columns = ['PatNum', 'First Name', 'Tenure', '#_of_Visits', 'Last Visit (days)']#, 'Risk Factor']
-    patients.index = patients.reset_index(drop=True).index + 1
-    return patients
-
-
-dropcols = ['PatNum', 'FName',  'Recency']
-#load data from source and get create original df and data for getting predictions
-link_data, test = load_data(link_data=for_model, drop_columns=dropcols)
-
-# load pretrained model and make predictions
-model = load_model('bestLRmodel.pkl')
-predict_probas = model.predict_proba(test)
+    return ContactIndex(contact)
+
+# serve the last good snapshot, new exports are scored in the background and swapped in when ready
+r = refresher()
+snapshot = r.current
+if snapshot is None:
+    st.info('Scoring patients for the first time, reload the page in a few minutes')
+    if r.error:
+        st.error(r.error)
+    st.stop()
+link_data, contact = snapshot.scores, snapshot.contact
+predict_probas = link_data['probability'].values
+st.caption(f'Data as of {snapshot.as_of:%Y-%m-%d %H:%M}' + (' (refreshing)' if r.refreshing else ''))
+
+# threshold chosen for the model on its holdout set, see model_functions.calibrate_threshold
+thresh = load_threshold('bestLRmodel.pkl')
 
 #allow use to input threshold value for prediction probabilities
 num_patients = st.text_input(label='# of Patients to Contact', value=10, max_chars=None, key=1, type='default')
-df = priority_list(link_data, predict_probas, num_patients=int(num_patients))
+df = priority_list(link_data, predict_probas, thresh=thresh, num_patients=int(num_patients))
 #st.title(f'Total # of Patients: {len(df)}')
 
 #display patient data on screen
@@ -86,9 +56,14 @@ st.table(df)
 
 st.title('Prioritized Contact List')
 num_patients2 = st.text_input(label='# of Patients to Contact', value=10, max_chars=None, key=2, type='default')
-contact_df = t.contact_transform(contact)
+
+#higher terms give the value less weight in the contact score, see Transform.contact_transform
+tenure_term = st.slider('Tenure term (days)', min_value=1, max_value=500, value=50, key=3)
+total_term = st.slider('Total term ($)', min_value=1, max_value=500, value=50, key=4)
+frequency_term = st.slider('Frequency term (visits)', min_value=1, max_value=100, value=10, key=5)
+contact_df = contact_index(contact).top(int(num_patients2), tenure_term, total_term, frequency_term)
 contact_df.index = contact_df.reset_index(drop=True).index + 1
-st.table(contact_df.iloc[:int(num_patients2)])
+st.table(contact_df)
 
 st.title('Conclusions')
 st.title('* Proactive Action:')
@@ -0,0 +1,722 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import pickle
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_functions import wrangle
+from db_source import DBTransform, load_sqlite, sqlite_source
+from ingest import StreamingTransform
+from model_functions import threshold_table, export_logistic, LogisticScorer
+import profiling
+from ranking import top_k
+from score import predict_in_chunks, priority_list, model_features
+from snapshot import PatientSnapshot
+from synthetic import make_practice, PROVNUMS
+from transform_data import (Transform, ContactIndex, raw_paths, parse_dates, provider_features, pay_aggregates,
+                            DATE_FORMATS, NULL_DATE, NULL_DATETIME, NULL_DATES, PROVIDERS)
+
+# ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def _child(queue, func, args):
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    func(*args)
+    queue.put({'wall_s': time.perf_counter() - start_wall,
+               'cpu_s': time.process_time() - start_cpu,
+               'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT / 2 ** 20})
+
+
+def _noop():
+    pass
+
+
+def measure(func, *args):
+    """
+    Runs func(*args) in a fresh process and measures it
+
+    Parameters:
+        func: module level function to run
+        args: picklable arguments for func
+
+    Returns:
+        Dict of wall time, CPU time and peak RSS of the process (including interpreter and library imports)
+    """
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_child, args=(queue, func, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _pay(transform, paths):
+    transform.pay_transform(paths['payment'], paths['claims'])
+
+
+def _patient(transform, paths):
+    transform.patient_transform(paths['appt'], paths['patient'])
+
+
+def bench_ingest(data_dir, chunksize=250000, bad_lines=None, **kwargs):
+    """
+    Compares the in-memory and streaming readers of pay_transform and patient_transform, and checks that the
+    streaming reader quarantines every malformed claims line
+
+    Parameters:
+        data_dir: directory holding the raw exports
+        chunksize: rows per chunk for the streaming reader
+        bad_lines: number of malformed claims lines in the export, None if unknown
+
+    Returns:
+        df of wall time, CPU time and peak RSS per stage and reader
+    """
+    paths = raw_paths(data_dir)
+    quarantine_dir = os.path.join(data_dir, 'quarantine')
+    quarantine_path = os.path.join(quarantine_dir, 'claims.csv')
+    if os.path.exists(quarantine_path):
+        os.remove(quarantine_path)
+    readers = {'current': Transform(), f'streaming ({chunksize} rows)': StreamingTransform(chunksize, quarantine_dir)}
+    rows = [dict(stage='baseline', reader='interpreter + imports', **measure(_noop))]
+    for name, transform in readers.items():
+        rows.append(dict(stage='pay_transform', reader=name, **measure(_pay, transform, paths)))
+        rows.append(dict(stage='patient_transform', reader=name, **measure(_patient, transform, paths)))
+
+    # the streaming reader runs in a child process, count the lines it quarantined (without the header)
+    quarantined = 0
+    if os.path.exists(quarantine_path):
+        with open(quarantine_path) as file:
+            quarantined = sum(1 for _ in file) - 1
+    print(f'{quarantined} malformed claims lines quarantined')
+    if bad_lines is not None:
+        np.testing.assert_equal(quarantined, bad_lines)
+    return pd.DataFrame(rows)
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    """
+    Times func in the current process
+
+    Parameters:
+        func: function to time
+        args, kwargs: arguments for func
+        repeat: number of runs, the fastest is reported
+
+    Returns:
+        Fastest wall time in seconds
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _provider_flags_loop(appt, pat):
+    # the per provider isin loop formerly used by patient_transform
+    provider_dict = {k: (appt[appt['ProvNum'] == k]['PatNum']).unique() for k in PROVIDERS}
+    for k in PROVIDERS:
+        pat[f'seen_by_{k}'] = np.where(pat['PatNum'].isin(provider_dict[k]), 1, 0)
+    return pat
+
+
+def _provider_flags_single_pass(appt, pat, providers=PROVIDERS, visit_counts=False):
+    features = provider_features(appt, providers, visit_counts).reindex(pat['PatNum'], fill_value=0)
+    for col in features.columns:
+        pat[col] = features[col].values
+    return pat
+
+
+def bench_providers(rows=5000000, **kwargs):
+    """
+    Compares the per provider isin loop with the single pass provider_features on a synthetic appointment table
+
+    Parameters:
+        rows: number of appointments, spread over rows / 20 patients
+
+    Returns:
+        df of the fastest wall time per implementation
+    """
+    rng = np.random.default_rng(0)
+    n_patients = max(rows // 20, 1)
+    appt = pd.DataFrame({'PatNum': rng.integers(1, n_patients + 1, rows), 'ProvNum': rng.choice(PROVNUMS, rows)})
+    pat = pd.DataFrame({'PatNum': np.arange(1, n_patients + 1)})
+
+    expected = _provider_flags_loop(appt, pat.copy())
+    pd.testing.assert_frame_equal(_provider_flags_single_pass(appt, pat.copy()), expected)
+
+    cases = {'isin loop (6 providers)': (_provider_flags_loop, {}),
+             'single pass (6 providers)': (_provider_flags_single_pass, {}),
+             'single pass (all providers)': (_provider_flags_single_pass, {'providers': None}),
+             'single pass (all providers + visit counts)': (_provider_flags_single_pass,
+                                                            {'providers': None, 'visit_counts': True})}
+    return pd.DataFrame([{'implementation': name, 'rows': rows, 'wall_s': timed(func, appt, pat.copy(), **options)}
+                         for name, (func, options) in cases.items()])
+
+
+def _priority_sort(probas, patnums, thresh, k):
+    # the full DataFrame sort formerly used by app.priority_list
+    preds = pd.DataFrame(probas)
+    churns = preds[preds[1] >= thresh].loc[:, 1].sort_values(ascending=False)
+    return churns.iloc[:k].index.values
+
+
+def _priority_top_k(probas, patnums, thresh, k):
+    churns = np.flatnonzero(probas[:, 1] >= thresh)
+    return churns[top_k(probas[churns, 1], k, patnums[churns])]
+
+
+def _contact_sort(scores, patnums, k):
+    # the full sort formerly used by contact_transform
+    return pd.Series(scores).sort_values().iloc[:k].index.values
+
+
+def _contact_top_k(scores, patnums, k):
+    return top_k(scores, k, patnums, largest=False)
+
+
+def bench_ranking(sizes=(100000, 1000000), k=50, **kwargs):
+    """
+    Compares full sorts with top_k partial selection for the priority and contact lists
+
+    Parameters:
+        sizes: numbers of patients to rank
+        k: number of patients selected
+
+    Returns:
+        df of the fastest wall time per list, implementation and size
+    """
+    rng = np.random.default_rng(0)
+    rows = []
+    for n in sizes:
+        patnums = rng.permutation(n) + 1
+        churn = rng.random(n)
+        probas = np.column_stack([1 - churn, churn])
+        scores = np.round(rng.normal(500, 100, n), 1)
+        cases = {('priority_list', 'full sort'): (_priority_sort, (probas, patnums, 0.48, k)),
+                 ('priority_list', 'top_k'): (_priority_top_k, (probas, patnums, 0.48, k)),
+                 ('contact_transform', 'full sort'): (_contact_sort, (scores, patnums, k)),
+                 ('contact_transform', 'top_k'): (_contact_top_k, (scores, patnums, k))}
+        for (stage, name), (func, args) in cases.items():
+            rows.append({'stage': stage, 'implementation': name, 'patients': n, 'k': k, 'wall_s': timed(func, *args)})
+    return pd.DataFrame(rows)
+
+
+def _date_strings(rows, rng, with_time=False):
+    days = np.datetime64('2005-01-01') + rng.integers(0, 365 * 16, rows).astype('timedelta64[D]')
+    if not with_time:
+        dates = np.datetime_as_string(days, unit='D').astype(object)
+    else:
+        stamps = days + (rng.integers(8, 17, rows) * 3600).astype('timedelta64[s]')
+        dates = np.char.replace(np.datetime_as_string(stamps, unit='s'), 'T', ' ').astype(object)
+    dates[rng.random(rows) < 0.01] = NULL_DATETIME if with_time else NULL_DATE
+    return pd.Series(dates)
+
+
+def _slice_and_infer(dates):
+    # AptDateTime as formerly parsed by patient_transform
+    return pd.to_datetime(dates[dates != NULL_DATETIME].str[:10])
+
+
+def _where_and_infer(dates):
+    # Birthdate as formerly parsed by patient_transform
+    return pd.to_datetime(np.where(dates == NULL_DATE, np.nan, dates))
+
+
+def _filter_and_infer(dates):
+    # DateFirstVisit as formerly parsed by patient_transform
+    return pd.to_datetime(dates[dates != NULL_DATE])
+
+
+def _known_format(dates, format, normalize=False):
+    parsed = parse_dates(dates, format, [NULL_DATES[format]])
+    return parsed.dt.normalize() if normalize else parsed
+
+
+def _todate(dates, **kwargs):
+    wrangle().todate(dates.to_frame('date'), ['date'], **kwargs)
+
+
+def bench_dates(rows=5000000, **kwargs):
+    """
+    Compares format inference with the known-format parse_dates for every parsed date column and wrangle.todate
+
+    Parameters:
+        rows: number of dates per column
+
+    Returns:
+        df of the fastest wall time per column and implementation
+    """
+    rng = np.random.default_rng(0)
+    appt_dates, pat_dates = _date_strings(rows, rng, with_time=True), _date_strings(rows, rng)
+    cases = {('AptDateTime', 'slice + inferred format'): (_slice_and_infer, appt_dates, {}),
+             ('AptDateTime', 'known format'): (_known_format, appt_dates,
+                                               {'format': DATE_FORMATS['AptDateTime'], 'normalize': True}),
+             ('Birthdate', 'np.where + inferred format'): (_where_and_infer, pat_dates, {}),
+             ('Birthdate', 'known format'): (_known_format, pat_dates, {'format': DATE_FORMATS['Birthdate']}),
+             ('DateFirstVisit', 'filter + inferred format'): (_filter_and_infer, pat_dates, {}),
+             ('DateFirstVisit', 'known format'): (_known_format, pat_dates,
+                                                  {'format': DATE_FORMATS['DateFirstVisit']}),
+             ('wrangle.todate', 'inferred format'): (_todate, pat_dates, {}),
+             ('wrangle.todate', 'known format'): (_todate, pat_dates, {'format': '%Y-%m-%d'})}
+    return pd.DataFrame([{'column': column, 'implementation': name, 'rows': rows,
+                          'wall_s': timed(func, dates, **options)}
+                         for (column, name), (func, dates, options) in cases.items()])
+
+
+def bench_dtypes(data_dir, **kwargs):
+    """
+    Compares the memory of every stage with default and compact dtypes, and checks that a logistic regression fitted
+    on the default dtypes predicts the same probabilities from the compact frame
+
+    Parameters:
+        data_dir: directory holding the raw exports
+
+    Returns:
+        df of rows and MB per stage and frame for both dtype plans
+    """
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    now = pd.Timestamp.now().normalize()
+    merged, reports = {}, []
+    for dtypes, compact in [('default', False), ('compact', True)]:
+        transform = Transform(compact=compact, track_memory=True)
+        merged[dtypes] = transform.run(data_dir, now=now)
+        reports.append(transform.memory_report().set_index(['stage', 'frame'])
+                       .rename(columns={'mb': f'{dtypes}_mb'}))
+
+    features = model_features(merged['default'])
+    model = make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000))
+    model.fit(features, merged['default']['Recency'] > 400)
+    expected = predict_in_chunks(model, features)
+    np.testing.assert_allclose(predict_in_chunks(model, model_features(merged['compact'])), expected, atol=1e-4)
+
+    report = reports[0].join(reports[1].drop(columns='rows'), how='outer')
+    report['ratio'] = report['compact_mb'] / report['default_mb']
+    return report.reset_index()
+
+
+def _threshold_loop(ytest, probas, thresholds):
+    # the per threshold sklearn metrics formerly computed by thresh_selection
+    from sklearn.metrics import f1_score, confusion_matrix
+    rows = []
+    for thresh in thresholds:
+        predicted = (probas >= thresh).astype('int')
+        tn, fp, fn, tp = confusion_matrix(ytest, predicted, labels=[0, 1]).ravel()
+        rows.append({'threshold': thresh, 'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn, 'f1': f1_score(ytest, predicted)})
+    return pd.DataFrame(rows)
+
+
+def bench_thresholds(rows=5000000, steps=(20, 200), **kwargs):
+    """
+    Compares per threshold sklearn metrics with the cumulative sum threshold_table
+
+    Parameters:
+        rows: number of holdout patients
+        steps: numbers of thresholds swept between 0 and 1
+
+    Returns:
+        df of the fastest wall time per implementation and number of thresholds
+    """
+    rng = np.random.default_rng(0)
+    probas = rng.random(rows)
+    ytest = (rng.random(rows) < probas).astype('int')
+    results = []
+    for n in steps:
+        thresholds = np.linspace(0, 1, n, endpoint=False)
+        expected = _threshold_loop(ytest, probas, thresholds)
+        table = threshold_table(ytest, probas, thresholds)
+        pd.testing.assert_frame_equal(table[expected.columns], expected, check_dtype=False)
+        results += [{'implementation': 'sklearn loop', 'thresholds': n, 'rows': rows,
+                     'wall_s': timed(_threshold_loop, ytest, probas, thresholds, repeat=1)},
+                    {'implementation': 'threshold_table', 'thresholds': n, 'rows': rows,
+                     'wall_s': timed(threshold_table, ytest, probas, thresholds)}]
+    return pd.DataFrame(results)
+
+
+def _fit_logistic(model_dir, rows, n_features=20):
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    rng = np.random.default_rng(0)
+    features = pd.DataFrame(rng.normal(size=(rows, n_features)) * rng.uniform(1, 1000, n_features),
+                            columns=[f'feature_{i}' for i in range(n_features)])
+    churn = features.to_numpy() @ rng.normal(size=n_features) / 1000 + rng.normal(size=rows) > 0
+    model = make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000)).fit(features, churn)
+    model_path = os.path.join(model_dir, 'model.pkl')
+    with open(model_path, 'wb') as file:
+        pickle.dump(model, file)
+    export_logistic(model, model_path)
+    return model, model_path, features
+
+
+def _unpickle_and_score(model_path, features):
+    with open(model_path, 'rb') as file:
+        pickle.load(file).predict_proba(features)
+
+
+def _load_logistic_and_score(model_path, features):
+    LogisticScorer(model_path).predict_proba(features)
+
+
+def bench_inference(rows=5000000, **kwargs):
+    """
+    Compares the pickled sklearn pipeline with the exported LogisticScorer, cold start in a fresh process (sklearn
+    import, unpickle or memory map, scoring 1000 rows) and scoring latency in the current process
+
+    Parameters:
+        rows: number of rows scored for the latency comparison
+
+    Returns:
+        df of wall time, CPU time and peak RSS per stage and implementation
+    """
+    with tempfile.TemporaryDirectory() as model_dir:
+        model, model_path, features = _fit_logistic(model_dir, rows)
+        scorer = LogisticScorer(model_path)
+        np.testing.assert_allclose(scorer.predict_proba(features), model.predict_proba(features), atol=1e-9)
+
+        sample = features.iloc[:1000]
+        results = [dict(stage='baseline', implementation='interpreter + imports', **measure(_noop)),
+                   dict(stage='cold start', implementation='sklearn unpickle',
+                        **measure(_unpickle_and_score, model_path, sample)),
+                   dict(stage='cold start', implementation='LogisticScorer',
+                        **measure(_load_logistic_and_score, model_path, sample))]
+        for name, predict in [('sklearn unpickle', model.predict_proba), ('LogisticScorer', scorer.predict_proba)]:
+            results.append({'stage': f'score {rows} rows', 'implementation': name, 'wall_s': timed(predict, features)})
+    return pd.DataFrame(results)
+
+
+def _run_csv(data_dir, now):
+    Transform().run(data_dir, now=now)
+
+
+def _run_db(db_path, now):
+    DBTransform(sqlite_source(db_path)).run(now=now)
+
+
+def bench_db(data_dir, **kwargs):
+    """
+    Compares Transform on the csv exports with DBTransform on a SQLite copy of them, where the filters and per
+    patient aggregations run in SQL
+
+    Parameters:
+        data_dir: directory holding the raw exports
+
+    Returns:
+        df of wall time, CPU time and peak RSS per source
+    """
+    now = pd.Timestamp.now().normalize()
+    with tempfile.TemporaryDirectory() as db_dir:
+        db_path = os.path.join(db_dir, 'practice.db')
+        load_sqlite(data_dir, db_path)
+        return pd.DataFrame([dict(source='baseline', **measure(_noop)),
+                             dict(source='csv exports', **measure(_run_csv, data_dir, now)),
+                             dict(source='SQLite, pushed down', **measure(_run_db, db_path, now))])
+
+
+def _identity(x):
+    return x
+
+
+def _call_loop(func, calls):
+    for i in range(calls):
+        func(i)
+
+
+def bench_profiling(data_dir, calls=1000000, **kwargs):
+    """
+    Measures the cost of the profiled decorator, per call while profiling is disabled and on a full Transform.run
+    while it is disabled and enabled
+
+    Parameters:
+        data_dir: directory holding the raw exports
+        calls: number of calls for the per call overhead
+
+    Returns:
+        df of the fastest wall time per case
+    """
+    now = pd.Timestamp.now().normalize()
+    rows = [{'case': f'{calls} calls, undecorated', 'wall_s': timed(_call_loop, _identity, calls)},
+            {'case': f'{calls} calls, profiled (disabled)',
+             'wall_s': timed(_call_loop, profiling.profiled()(_identity), calls)},
+            {'case': 'Transform.run, profiling disabled', 'wall_s': timed(Transform().run, data_dir, now=now)}]
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_path = os.path.join(log_dir, 'profile.jsonl')
+        profiling.enable(log_path)
+        try:
+            rows.append({'case': 'Transform.run, profiling enabled',
+                         'wall_s': timed(Transform().run, data_dir, now=now)})
+        finally:
+            profiling.disable()
+        print(profiling.summarize(log_path).to_string())
+    return pd.DataFrame(rows)
+
+
+def _contact_columns(contact, tenure_term, total_term, frequency_term, k):
+    # the column arithmetic formerly used by contact_transform on every call
+    df = contact.loc[:, ['PatNum', 'FName', 'Recency', 'Tenure', 'Total', 'Frequency']]
+    df['Score'] = df['Recency'] - df['Tenure']/tenure_term - df['Total']/total_term - df['Frequency']/frequency_term
+    df = df.iloc[top_k(df['Score'].values, k, df['PatNum'].values, largest=False)]
+    df['FName'] = df['FName'].str[0].str.upper() + df['FName'].str[1:].str.lower()
+    df['Total'] = round(df['Total']).apply(lambda x : "${:,}".format(x))
+    return df
+
+
+def bench_contact(sizes=(100000, 1000000), k=50, **kwargs):
+    """
+    Compares rescoring the contact list from the frame against a prebuilt ContactIndex, as when a manager moves a
+    score slider
+
+    Parameters:
+        sizes: numbers of patients in the contact window
+        k: number of patients shown
+
+    Returns:
+        df of the fastest wall time per implementation and size
+    """
+    rng = np.random.default_rng(0)
+    terms = (30, 70, 5)
+    rows = []
+    for n in sizes:
+        contact = pd.DataFrame({'PatNum': rng.permutation(n) + 1, 'FName': rng.choice(['mary', 'JAMES'], n),
+                                'Recency': rng.integers(400, 720, n), 'Tenure': rng.integers(0, 5000, n),
+                                'Total': np.round(rng.gamma(2, 500, n), 2), 'Frequency': rng.integers(1, 40, n)})
+        index = ContactIndex(contact)
+        expected = _contact_columns(contact, *terms, k)
+        shown = index.top(k, *terms)
+        np.testing.assert_array_equal(shown['PatNum'].values, expected['PatNum'].values)
+        np.testing.assert_allclose(shown['Score'].values, expected['Score'].values)
+
+        cases = {'column arithmetic per move': (_contact_columns, (contact, *terms, k)),
+                 'ContactIndex build per data load': (ContactIndex, (contact,)),
+                 'ContactIndex.top per move': (index.top, (k, *terms))}
+        rows += [{'implementation': name, 'patients': n, 'k': k, 'wall_s': timed(func, *args)}
+                 for name, (func, args) in cases.items()]
+    return pd.DataFrame(rows)
+
+
+def bench_snapshot(data_dir, **kwargs):
+    """
+    Compares data_split on a freshly built frame with the binary search windows of a PatientSnapshot, and checks that
+    both agree as of the build
+
+    Parameters:
+        data_dir: directory holding the raw exports
+
+    Returns:
+        df of the fastest wall time per implementation
+    """
+    now = pd.Timestamp.now().normalize()
+    t = Transform()
+    merged = t.run(data_dir, now=now)
+    snapshot = PatientSnapshot.build(data_dir, Transform(keep_dates=True), now=now)
+    for expected, window in zip(t.data_split(merged), snapshot.data_split(now)):
+        pd.testing.assert_frame_equal(window, expected.sort_values('PatNum').reset_index(drop=True))
+
+    as_of = now - pd.Timedelta(days=90)
+    cases = {'Transform.run + data_split (as of now)': lambda: t.data_split(t.run(data_dir, now=now)),
+             'data_split (as of now)': lambda: t.data_split(merged),
+             'PatientSnapshot.data_split (as of now)': lambda: snapshot.data_split(now),
+             'PatientSnapshot.data_split (90 days ago)': lambda: snapshot.data_split(as_of)}
+    return pd.DataFrame([{'implementation': name, 'patients': len(merged), 'wall_s': timed(func)}
+                         for name, func in cases.items()])
+
+
+def _pay_merges(pay, claims, patient):
+    # the separate groupbys and hash merges formerly used by pay_transform and merge_transform
+    grouped_pay = pay.groupby('PatNum', as_index=False)['PayAmt'].sum()
+    grouped_claims = claims.groupby('PatNum', as_index=False)['InsPayAmt'].sum()
+    total = grouped_claims.merge(grouped_pay)
+    total['Total'] = total['InsPayAmt'] + total['PayAmt']
+    return patient.merge(total.loc[:, ['PatNum', 'Total']])
+
+
+def _pay_fused(transform, pay, claims, patient, now):
+    grouped = pay_aggregates(pay, claims, now=now, dated=transform.lifetime_features)
+    return transform.merge_transform(patient, transform.pay_totals(grouped, now=now))
+
+
+def bench_pay(rows=5000000, **kwargs):
+    """
+    Compares per table groupbys joined by hash merges with the single pay_aggregates groupby joined on its PatNum
+    index, and checks that the fused pass keeps the patients found in only one of the tables
+
+    Parameters:
+        rows: number of payment rows, there are half as many claims rows
+
+    Returns:
+        df of the fastest wall time per implementation
+    """
+    rng = np.random.default_rng(0)
+    n_patients = max(rows // 50, 1)
+    now = pd.Timestamp('2021-06-30')
+    dates = pd.Series((now - pd.to_timedelta(rng.integers(0, 3650, rows), unit='D')).strftime('%Y-%m-%d'))
+    pay = pd.DataFrame({'PatNum': rng.integers(1, n_patients + 1, rows), 'PayDate': dates,
+                        'PayAmt': np.round(rng.gamma(2, 40, rows), 2)})
+    claims = pd.DataFrame({'PatNum': rng.integers(1, n_patients + 1, rows // 2), 'DateReceived': dates[:rows // 2],
+                           'InsPayAmt': np.round(rng.gamma(2, 80, rows // 2), 2)})
+    patient = pd.DataFrame({'PatNum': rng.permutation(n_patients) + 1, 'Recency': rng.integers(0, 720, n_patients)})
+
+    t, lifetime = Transform(compact=False), Transform(compact=False, lifetime_features=True)
+    expected, fused = _pay_merges(pay, claims, patient), _pay_fused(t, pay, claims, patient, now)
+    both = fused[fused['PatNum'].isin(expected['PatNum'])].reset_index(drop=True)
+    pd.testing.assert_frame_equal(both, expected)
+    print(f'{len(fused) - len(expected)} patients with only payments or only claims kept by the fused pass')
+
+    cases = {'groupby per table + merges': (_pay_merges, (pay, claims, patient)),
+             'pay_aggregates + index join': (_pay_fused, (t, pay, claims, patient, now)),
+             'pay_aggregates + index join (lifetime features)': (_pay_fused, (lifetime, pay, claims, patient, now))}
+    return pd.DataFrame([{'implementation': name, 'rows': rows, 'wall_s': timed(func, *args)}
+                         for name, (func, args) in cases.items()])
+
+
+# end of the synthetic history and reference time of the suite, fixed so results are comparable across days
+SUITE_END = '2021-06-30'
+
+
+def _run_once(rows, stage, patients, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    wall = time.perf_counter() - start
+    rows_out = len(result[0] if isinstance(result, tuple) else result) if result is not None else None
+    rows.append({'stage': stage, 'patients': patients, 'rows_out': rows_out, 'wall_s': wall})
+    return result
+
+
+def bench_suite(sizes=(10000, 100000, 1000000), **kwargs):
+    """
+    Times the Transform stages, the dashboard lists and the KMeans helpers on synthetic practices
+
+    Parameters:
+        sizes: numbers of synthetic patients
+
+    Returns:
+        df of the wall time and output rows per stage and practice size
+    """
+    from KMeans import select_k, create_labels
+
+    now = pd.Timestamp(SUITE_END)
+    rows = []
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as data_dir:
+            make_practice(data_dir, n, end=SUITE_END)
+            paths = raw_paths(data_dir)
+            t = Transform()
+            total = _run_once(rows, 'pay_transform', n, t.pay_transform, paths['payment'], paths['claims'], now=now)
+            patient = _run_once(rows, 'patient_transform', n, t.patient_transform, paths['appt'], paths['patient'],
+                                now=now)
+            merged = _run_once(rows, 'merge_transform', n, t.merge_transform, patient, total)
+            for_model, contact = _run_once(rows, 'data_split', n, t.data_split, merged)
+            _run_once(rows, 'contact_transform', n, t.contact_transform, contact, num_patients=50)
+            probas = np.random.default_rng(0).random(len(for_model))
+            _run_once(rows, 'priority_list', n, priority_list, for_model, probas, num_patients=50)
+
+            _run_once(rows, 'select_k', n, select_k, merged, ['Recency'], range(1, 8))
+            _run_once(rows, 'select_k (warm start)', n, select_k, merged, ['Recency'], range(1, 8), warm_start=True)
+            model_path = os.path.join(data_dir, 'segmentation.npz')
+            _run_once(rows, 'create_labels (fit)', n, create_labels, merged, ['Recency', 'Total'], 4, model_path)
+            _run_once(rows, 'create_labels (assign)', n, create_labels, merged, ['Recency', 'Total'], 4, model_path)
+    return pd.DataFrame(rows)
+
+
+BENCHMARKS = {'ingest': bench_ingest, 'providers': bench_providers, 'ranking': bench_ranking, 'dates': bench_dates,
+              'dtypes': bench_dtypes, 'thresholds': bench_thresholds, 'inference': bench_inference,
+              'db': bench_db, 'profiling': bench_profiling, 'suite': bench_suite,
+              'contact': bench_contact, 'snapshot': bench_snapshot, 'pay': bench_pay}
+
+# result columns holding measurements, the other columns identify a row when comparing with a baseline
+MEASURES = {'wall_s', 'cpu_s', 'peak_rss_mb', 'rows_out'}
+
+
+def compare_baseline(name, result, baseline, tolerance=1.25):
+    """
+    Compares the wall times of a benchmark result with a stored baseline
+
+    Parameters:
+        name: benchmark name
+        result: df returned by the benchmark
+        baseline: dict of benchmark name to the records of a previous result, see main --save-baseline
+        tolerance: slowdown ratio above which a row is flagged as a regression
+
+    Returns:
+        result with baseline_s, ratio and regression columns, unchanged if the benchmark has no stored wall times
+    """
+    if 'wall_s' not in result or name not in baseline:
+        return result
+    stored = pd.DataFrame(baseline[name])
+    if 'wall_s' not in stored:
+        return result
+    keys = [col for col in result.columns if col not in MEASURES and col in stored]
+    stored = stored[keys + ['wall_s']].rename(columns={'wall_s': 'baseline_s'})
+    result = result.merge(stored, on=keys, how='left')
+    result['ratio'] = result['wall_s'] / result['baseline_s']
+    result['regression'] = result['ratio'] > tolerance
+    return result
+
+# benchmarks that run on raw exports rather than generating their own data
+DATA_BENCHMARKS = {'ingest', 'dtypes', 'db', 'profiling', 'snapshot'}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for the dental churn pipeline')
+    parser.add_argument('benchmarks', nargs='*', help=f'benchmarks to run, any of {list(BENCHMARKS)} (default all)')
+    parser.add_argument('--data-dir', help='raw exports to benchmark on, synthetic data is generated if omitted')
+    parser.add_argument('--patients', type=int, default=100000, help='number of synthetic patients')
+    parser.add_argument('--chunksize', type=int, default=250000, help='rows per chunk for streaming readers')
+    parser.add_argument('--rows', type=int, default=5000000, help='rows of in-memory synthetic tables')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='numbers of synthetic patients for the suite and ranking benchmarks')
+    parser.add_argument('--baseline', help='json results of a previous run to compare wall times against')
+    parser.add_argument('--save-baseline', help='json file the results of this run are written to')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks {sorted(unknown)}')
+    args.benchmarks = args.benchmarks or list(BENCHMARKS)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    results, regressions = {}, []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir, bad_lines = args.data_dir, None
+        if data_dir is None and DATA_BENCHMARKS.intersection(args.benchmarks):
+            data_dir = tmp_dir
+            counts = make_practice(data_dir, args.patients)
+            bad_lines = counts['bad_lines']
+            print(f'generating {args.patients} synthetic patients: {counts}')
+        for name in args.benchmarks:
+            print(f'\n== {name} ==')
+            result = BENCHMARKS[name](data_dir=data_dir, chunksize=args.chunksize, rows=args.rows,
+                                      sizes=args.sizes, bad_lines=bad_lines)
+            results[name] = json.loads(result.to_json(orient='records'))
+            result = compare_baseline(name, result, baseline, args.tolerance)
+            if 'regression' in result and result['regression'].any():
+                regressions.append(name)
+            print(result.to_string(index=False))
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            json.dump(results, file, indent=2)
+    if regressions:
+        print(f'\nslower than {args.tolerance}x the baseline: {regressions}')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
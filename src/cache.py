@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+from functools import partial
+
+import pandas as pd
+from pyarrow import feather
+
+from profiling import profiled
+from transform_data import Transform, raw_paths
+
+# bump whenever a stage's output changes so stale artifacts are never reused
+CACHE_VERSION = 4
+
+
+def file_digest(filepath, block_size=1 << 20):
+    """
+    Hashes the contents of a file
+
+    Parameters:
+        filepath: path to the file
+        block_size: number of bytes read at a time
+
+    Returns:
+        Hex sha1 digest of the file contents
+    """
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as file:
+        for block in iter(partial(file.read, block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_artifact(df, path):
+    """
+    Writes a DataFrame as a Feather file, replacing any existing file atomically
+
+    Parameters:
+        df: DataFrame to write, the index is not kept
+        path: destination filepath
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    df.reset_index(drop=True).to_feather(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def read_artifact(path):
+    """
+    Reads a Feather file written by write_artifact through a memory map
+
+    Parameters:
+        path: filepath of the artifact
+
+    Returns:
+        Pandas DataFrame
+    """
+    return feather.read_table(path, memory_map=True).to_pandas()
+
+
+class StageCache:
+    """
+    Persistent store for pipeline stage outputs.  Each output is keyed on the paths, sizes and content hashes of its
+    input files, the stage parameters and the keys of any upstream stages, so an input change only invalidates the
+    stages that depend on it.  File hashes are remembered per (mtime, size) so unchanged inputs are never re-read.
+    Keys change with every new export and every day the time dependent stages are run, so only the keep most
+    recently used outputs of each stage are kept.
+    """
+
+    def __init__(self, cache_dir, keep=4):
+        """
+        Parameters:
+            cache_dir: directory the artifacts and file fingerprints are stored in
+            keep: number of outputs kept per stage, older ones are removed when a new output is stored
+        """
+        self.cache_dir = cache_dir
+        self.keep = keep
+        os.makedirs(cache_dir, exist_ok=True)
+        self._hash_path = os.path.join(cache_dir, 'fingerprints.json')
+        self._hashes = {}
+        if os.path.exists(self._hash_path):
+            with open(self._hash_path) as file:
+                self._hashes = json.load(file)
+
+    def fingerprint(self, filepath):
+        """
+        Fingerprints an input file
+
+        Parameters:
+            filepath: path to the input file
+
+        Returns:
+            Dict with the absolute path, size and content hash of the file
+        """
+        path = os.path.abspath(filepath)
+        stat = os.stat(path)
+        mtime, size, digest = self._hashes.get(path, (None, None, None))
+        if (mtime, size) != (stat.st_mtime_ns, stat.st_size):
+            digest = file_digest(path)
+            self._hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+            tmp_path = f'{self._hash_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as file:
+                json.dump(self._hashes, file)
+            os.replace(tmp_path, self._hash_path)
+        return {'path': path, 'size': stat.st_size, 'sha1': digest}
+
+    def key(self, stage, inputs=(), params=None, upstream=()):
+        """
+        Computes the cache key of a stage
+
+        Parameters:
+            stage: name of the stage
+            inputs: filepaths the stage reads
+            params: dict of stage parameters, values must be json serializable
+            upstream: keys of the stages whose outputs feed this stage
+
+        Returns:
+            Hex key identifying the stage output
+        """
+        payload = {'stage': stage,
+                   'version': CACHE_VERSION,
+                   'inputs': [self.fingerprint(path) for path in inputs],
+                   'params': params or {},
+                   'upstream': list(upstream)}
+        return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def path(self, stage, key):
+        return os.path.join(self.cache_dir, f'{stage}-{key}.feather')
+
+    def get_or_build(self, stage, build, inputs=(), params=None, upstream=()):
+        """
+        Loads a stage output from the cache, building and storing it first on a miss
+
+        Parameters:
+            stage: name of the stage
+            build: callable with no arguments that returns the stage output DataFrame
+            inputs, params, upstream: see key
+
+        Returns:
+            Stage output DataFrame
+        """
+        path = self.path(stage, self.key(stage, inputs, params, upstream))
+        if os.path.exists(path):
+            # the modification time marks the last use, see prune
+            os.utime(path)
+            return read_artifact(path)
+        df = build()
+        write_artifact(df, path)
+        self.prune(stage)
+        return df
+
+    def prune(self, stage):
+        """
+        Removes all but the keep most recently used outputs of a stage
+
+        Parameters:
+            stage: name of the stage
+        """
+        prefix = f'{stage}-'
+        paths = [os.path.join(self.cache_dir, filename) for filename in os.listdir(self.cache_dir)
+                 if filename.startswith(prefix) and filename.endswith('.feather')]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for path in paths[self.keep:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # removed by another process pruning the same stage
+                pass
+
+    def clear(self):
+        """
+        Removes every stored artifact and file fingerprint
+        """
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.feather') or filename == 'fingerprints.json':
+                os.remove(os.path.join(self.cache_dir, filename))
+        self._hashes = {}
+
+
+class CachedTransform(Transform):
+    """
+    Transform whose pay, patient and merged stages are served from a StageCache.  Stages that depend on the current
+    time are computed as of midnight of the current day so their outputs stay valid for the whole day.  Misses are
+    built by the next class in the MRO, so the cache can be layered over another Transform subclass, e.g.
+    class CachedStreamingTransform(CachedTransform, StreamingTransform).
+    """
+
+    def __init__(self, cache_dir='../data/cache', keep=4, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = StageCache(cache_dir, keep)
+
+    @staticmethod
+    def _as_of(now):
+        return pd.Timestamp.now().normalize() if now is None else pd.Timestamp(now)
+
+    def _pay_params(self, now):
+        params = {'compact': self.compact, 'lifetime_features': self.lifetime_features}
+        if self.lifetime_features:
+            params['now'] = now.isoformat()
+        return params
+
+    def _patient_params(self, now):
+        return {'now': now.isoformat(), 'providers': self.providers, 'provider_visits': self.provider_visits,
+                'compact': self.compact, 'keep_dates': self.keep_dates}
+
+    @profiled()
+    def pay_transform(self, pay_filepath, claims_filepath, now=None):
+        now = self._as_of(now)
+        pay_transform = super().pay_transform
+
+        # artifacts do not keep the index, the PatNum index is stored as a column
+        def build():
+            return pay_transform(pay_filepath, claims_filepath, now=now).reset_index()
+        total = self.cache.get_or_build('pay', build, inputs=[pay_filepath, claims_filepath],
+                                        params=self._pay_params(now))
+        return total.set_index('PatNum')
+
+    @profiled()
+    def patient_transform(self, appt_filepath, pat_filepath, now=None):
+        now = self._as_of(now)
+        build = partial(super().patient_transform, appt_filepath, pat_filepath, now=now)
+        return self.cache.get_or_build('patient', build, inputs=[appt_filepath, pat_filepath],
+                                       params=self._patient_params(now))
+
+    @profiled()
+    def run(self, data_dir, now=None):
+        now = self._as_of(now)
+        paths = raw_paths(data_dir)
+        upstream = [self.cache.key('pay', inputs=[paths['payment'], paths['claims']], params=self._pay_params(now)),
+                    self.cache.key('patient', inputs=[paths['appt'], paths['patient']],
+                                   params=self._patient_params(now))]
+        build = partial(super().run, data_dir, now=now)
+        return self.cache.get_or_build('merged', build, upstream=upstream)
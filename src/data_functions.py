@@ -1,21 +1,37 @@
 import pandas as pd
 import matplotlib.pyplot as plt
+from transform_data import parse_dates
 
 class wrangle:
     def __init__(self):
         pass
     
     def downcast(self, df):
-        float_cols = df.dtypes[df.dtypes == float].index
-        int_cols = df.dtypes[df.dtypes == int].index
-        for col in float_cols:
+        '''
+        Downcasts numeric columns to the smallest dtype holding their values
+        Input: df
+        Output: df, modified in place. Integer columns without negative values become unsigned
+                (see transform_data.FEATURE_DTYPES for the dtype plan of the transform outputs)
+        '''
+        for col in df.select_dtypes('floating').columns:
             df[col] = pd.to_numeric(df[col], downcast='float')
-        for col in int_cols:
-            df[col] = pd.to_numeric(df[col], downcast='integer')
-        
-    def todate(self, df, list_of_cols):
+        for col in df.select_dtypes('integer').columns:
+            unsigned = not df.empty and df[col].min() >= 0
+            df[col] = pd.to_numeric(df[col], downcast='unsigned' if unsigned else 'integer')
+        return df
+
+    def todate(self, df, list_of_cols, format=None, sentinels=()):
+        '''
+        Converts columns to datetime, unparseable values become NaT
+        Input: df, list of column names, optional strftime format shared by the columns and sentinel dates
+        Output: None, df is modified in place. With a format the columns are parsed in a single known-format pass
+                (see transform_data.parse_dates) instead of inferring the format
+        '''
         for col in list_of_cols:
-            df[col] = pd.to_datetime(df[col], errors='coerce')
+            if format is None:
+                df[col] = pd.to_datetime(df[col], errors='coerce')
+            else:
+                df[col] = parse_dates(df[col], format, sentinels)
 
     def patient_dropper(self, df, target_col, targets):
         for target in targets:
@@ -0,0 +1,273 @@
+import contextlib
+import queue
+import sqlite3
+import threading
+from functools import partial
+
+import pandas as pd
+
+from profiling import profiled
+from transform_data import (Transform, raw_paths, provider_features, parse_dates, DATE_FORMAT, DATE_FORMATS,
+                            BAD_PAY_DATE, NULL_DATE, NULL_DATETIME, FAKE_PATIENTS, PATIENT_COLS, SPEND_WINDOW_DAYS)
+
+# practice software tables holding the rows of the raw exports, keyed by export
+TABLES = {'payment': 'payment', 'claims': 'claim', 'appt': 'appointment', 'patient': 'patient'}
+
+# placeholder for a query parameter per DB-API paramstyle (sqlite3 uses qmark, pymysql and MySQLdb pyformat)
+PLACEHOLDERS = {'qmark': '?', 'format': '%s', 'pyformat': '%s'}
+
+
+class ConnectionPool:
+    """
+    Minimal thread safe pool of DB-API connections, at most size connections are open at a time
+    """
+
+    def __init__(self, connect, size=4):
+        """
+        Parameters:
+            connect: function returning a new DB-API connection
+            size: maximum number of open connections
+        """
+        self.connect = connect
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager lending a connection, which is returned to the pool unless the block raised
+        """
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+            try:
+                yield conn
+                # end the read transaction so the next borrower sees fresh data
+                conn.rollback()
+            except Exception:
+                conn.close()
+                raise
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class DBSource:
+    """
+    Reads query results over pooled DB-API connections in fetchmany batches.  Any DB-API driver works, e.g.
+    sqlite3 or pymysql (pass cursorclass=pymysql.cursors.SSCursor to connect to stream results from the server
+    instead of buffering them on the client).
+    """
+
+    def __init__(self, connect, pool_size=4, paramstyle='qmark', tables=None, batch_size=50000):
+        """
+        Parameters:
+            connect: function returning a new DB-API connection
+            pool_size: maximum number of open connections
+            paramstyle: DB-API paramstyle of the driver, see PLACEHOLDERS
+            tables: dict overriding TABLES
+            batch_size: rows per fetchmany call
+        """
+        self.pool = ConnectionPool(connect, pool_size)
+        self.placeholder = PLACEHOLDERS[paramstyle]
+        self.tables = {**TABLES, **(tables or {})}
+        self.batch_size = batch_size
+
+    def params(self, n):
+        return ', '.join([self.placeholder] * n)
+
+    def query(self, sql, params=()):
+        """
+        Runs a query and collects its rows batch by batch
+
+        Parameters:
+            sql: query, with placeholders for params
+            params: sequence of query parameters
+
+        Returns:
+            df of the result rows
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql, list(params))
+                columns = [description[0] for description in cursor.description]
+                frames = []
+                while True:
+                    rows = cursor.fetchmany(self.batch_size)
+                    if not rows:
+                        break
+                    frames.append(pd.DataFrame.from_records(rows, columns=columns))
+            finally:
+                cursor.close()
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+
+def sqlite_source(db_path, **kwargs):
+    """
+    DBSource over a SQLite database file, e.g. one written by load_sqlite
+    """
+    return DBSource(partial(sqlite3.connect, db_path, check_same_thread=False), paramstyle='qmark', **kwargs)
+
+
+def _as_text(dates):
+    # drivers return DATE/DATETIME columns as date objects, their str() is the format of the raw exports
+    return dates.map(str, na_action='ignore') if dates.dtype == object else dates
+
+
+class DBTransform(Transform):
+    """
+    Transform that reads straight from the practice database instead of the csv exports.  The cleaning filters
+    (BAD_PAY_DATE payments, unreceived claims, cancelled appointments, fake patients and NULL_DATE appointment
+    dates) and the per PatNum aggregations run in SQL, so only one row per patient (or per patient and provider)
+    is fetched from the payment, claim and appointment tables.  The patient table is fetched whole, the mean age
+    used to fill missing birthdates is taken over every patient as in the csv path.
+
+    CLAIMS_CORRECTIONS is keyed by row of the claims export, which has no meaning in the database, so corrections
+    are passed as claim_corrections keyed by ClaimNum instead.
+
+    pay_transform, patient_transform and run keep the signatures of Transform so callers of run(data_dir, now) can
+    be handed a DBTransform, but their filepath and data_dir arguments are ignored.  The stage cache is keyed on the
+    csv exports, so DBTransform is not layered under CachedTransform.
+    """
+
+    def __init__(self, source, claim_corrections=None, **kwargs):
+        """
+        Parameters:
+            source: DBSource of the practice database
+            claim_corrections: dict of ClaimNum to corrected InsPayAmt
+        """
+        super().__init__(**kwargs)
+        self.source = source
+        self.claim_corrections = claim_corrections or {}
+
+    @profiled()
+    def fetch(self, table, sql, params=()):
+        df = self.source.query(sql, params)
+        dtypes = self.read_dtypes(table) or {}
+        df = df.astype({col: dtype for col, dtype in dtypes.items() if col in df})
+        self.track('read', table, df)
+        return df
+
+    def _appt_filter(self):
+        p = self.source.placeholder
+        sql = (f'PatNum IS NOT NULL AND (AptStatus IS NULL OR AptStatus <> {p}) '
+               f'AND PatNum NOT IN ({self.source.params(len(FAKE_PATIENTS))}) '
+               f'AND (AptDateTime IS NULL OR AptDateTime <> {p})')
+        return sql, [5, *FAKE_PATIENTS, NULL_DATETIME]
+
+    @profiled()
+    def pay_transform(self, pay_filepath=None, claims_filepath=None, now=None):
+        """
+        Equivalent of Transform.pay_transform on the payment and claim tables, the rows of both tables are
+        aggregated per PatNum by a single GROUP BY over their UNION ALL
+
+        Parameters:
+            pay_filepath, claims_filepath: ignored, kept for the signature of Transform.pay_transform
+            now: reference time of the lifetime features, defaults to the current time
+
+        Returns:
+            Table indexed by PatNum with Total of all patient payments over course of entire patient life
+        """
+        now = pd.to_datetime('now') if now is None else pd.to_datetime(now)
+        p, tables = self.source.placeholder, self.source.tables
+
+        amount, amount_params = 'InsPayAmt', []
+        if self.claim_corrections:
+            cases = ' '.join([f'WHEN {p} THEN {p}'] * len(self.claim_corrections))
+            amount = f'CASE ClaimNum {cases} ELSE InsPayAmt END'
+            amount_params = [value for item in self.claim_corrections.items() for value in item]
+        rows = (f'SELECT PatNum, PayAmt, 0 AS InsPayAmt, 0 AS IsClaim, NULLIF(PayDate, {p}) AS PayDate '
+                f'FROM {tables["payment"]} WHERE PatNum IS NOT NULL AND (PayDate IS NULL OR PayDate <> {p}) '
+                f'UNION ALL SELECT PatNum, 0 AS PayAmt, {amount} AS InsPayAmt, 1 AS IsClaim, DateReceived AS PayDate '
+                f'FROM {tables["claims"]} WHERE PatNum IS NOT NULL AND (DateReceived IS NULL OR DateReceived <> {p})')
+        rows_params = [NULL_DATE, BAD_PAY_DATE] + amount_params + [NULL_DATE]
+
+        columns, params = ['COALESCE(SUM(PayAmt), 0) AS PayAmt', 'COALESCE(SUM(InsPayAmt), 0) AS InsPayAmt',
+                           'SUM(1 - IsClaim) AS n_pay', 'SUM(IsClaim) AS n_claims'], []
+        if self.lifetime_features:
+            # dates are compared as ISO strings, the window covers the days after now - SPEND_WINDOW_DAYS up to now
+            today = now.normalize()
+            columns += ['MIN(PayDate) AS FirstPay', 'MAX(PayDate) AS LastPay',
+                        f'COALESCE(SUM(CASE WHEN PayDate >= {p} AND PayDate < {p} '
+                        'THEN COALESCE(PayAmt, 0) + COALESCE(InsPayAmt, 0) ELSE 0 END), 0) AS Spend12m']
+            params = [(today - pd.Timedelta(days=SPEND_WINDOW_DAYS - 1)).strftime(DATE_FORMAT),
+                      (today + pd.Timedelta(days=1)).strftime(DATE_FORMAT)]
+        grouped = self.fetch('payment', f'SELECT PatNum, {", ".join(columns)} FROM ({rows}) pay_rows '
+                                        'GROUP BY PatNum ORDER BY PatNum', params + rows_params)
+        if self.lifetime_features:
+            grouped['First Pay'] = parse_dates(_as_text(grouped.pop('FirstPay')), DATE_FORMAT)
+            grouped['Last Pay'] = parse_dates(_as_text(grouped.pop('LastPay')), DATE_FORMAT)
+        return self.pay_totals(grouped.set_index('PatNum'), now=now)
+
+    @profiled()
+    def patient_transform(self, appt_filepath=None, pat_filepath=None, now=None):
+        """
+        Equivalent of Transform.patient_transform on the appointment and patient tables
+
+        Parameters:
+            appt_filepath, pat_filepath: ignored, kept for the signature of Transform.patient_transform
+            now: reference time for age and Recency, defaults to the current time
+
+        Returns:
+            Merged DataFrame of appt and patient tables for use with model for predictions and contact list
+        """
+        tables = self.source.tables
+        where, params = self._appt_filter()
+        visits = self.fetch('appt', 'SELECT PatNum, COUNT(AptDateTime) AS Frequency, MAX(AptDateTime) AS LastVisit '
+                                    f'FROM {tables["appt"]} WHERE {where} GROUP BY PatNum ORDER BY PatNum', params)
+        last_visit = parse_dates(_as_text(visits.pop('LastVisit')), DATE_FORMATS['AptDateTime'])
+        visits['Last Visit'] = last_visit.dt.normalize()
+        visits = visits.set_index('PatNum')
+
+        counts = self.fetch('appt', f'SELECT PatNum, ProvNum, COUNT(*) AS n FROM {tables["appt"]} WHERE {where} '
+                                    'GROUP BY PatNum, ProvNum', params)
+        providers = provider_features(counts, self.providers, self.provider_visits, count_col='n')
+
+        pat = self.fetch('patient', f'SELECT {", ".join(PATIENT_COLS)} FROM {tables["patient"]}')
+        for col in ['Birthdate', 'DateFirstVisit']:
+            pat[col] = _as_text(pat[col])
+        return self.patient_features(pat, visits, providers, now=now)
+
+    @profiled()
+    def run(self, data_dir=None, now=None):
+        """
+        Runs pay_transform and patient_transform on the database and merges the results
+
+        Parameters:
+            data_dir: ignored, kept for the signature of Transform.run
+            now: reference time for age, Recency and the lifetime features, defaults to the current time
+
+        Returns:
+            Merged DataFrame ready for data_split
+        """
+        return self.merge_transform(self.patient_transform(now=now), self.pay_transform(now=now))
+
+
+def load_sqlite(data_dir, db_path):
+    """
+    Loads the raw csv exports into a SQLite database laid out like the practice database, a local stand-in for
+    DBTransform.  Row labels of the exports become the PayNum, ClaimNum and AptNum keys, so CLAIMS_CORRECTIONS can
+    be passed to DBTransform as claim_corrections.
+
+    Parameters:
+        data_dir: directory holding the raw exports
+        db_path: SQLite database file, existing tables are replaced
+    """
+    t = Transform(compact=False)
+    paths = raw_paths(data_dir)
+    tables = [('payment', t.read_payments, 'PayNum'), ('claims', t.read_claims, 'ClaimNum'),
+              ('appt', t.read_appts, 'AptNum'), ('patient', t.read_patients, None)]
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        for table, read, key in tables:
+            df = read(paths[table])
+            df.to_sql(TABLES[table], conn, if_exists='replace', index=key is not None, index_label=key)
+        conn.commit()
+
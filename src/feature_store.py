@@ -0,0 +1,255 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from cache import read_artifact, write_artifact
+from transform_data import Transform, raw_paths, provider_features, PROVIDERS
+
+# raw date column each table is watermarked on
+DATE_COLS = {'appt': 'AptDateTime', 'payment': 'PayDate', 'claims': 'DateReceived'}
+
+
+def _window(df, date_col, begin=None, end=None):
+    """
+    Splits raw rows on their ISO date strings into rows dated in (begin, end] and the rest
+
+    Parameters:
+        df: raw table
+        date_col: column of ISO formatted date strings
+        begin: exclusive start date, None for no lower bound
+        end: inclusive end date
+
+    Returns:
+        Rows inside the window and rows dated after end or without a date
+    """
+    dates = df[date_col]
+    after_end = dates >= (end + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    tail = after_end | dates.isna()
+    inside = ~tail
+    if begin is not None:
+        inside &= dates >= (begin + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    return df[inside], df[tail]
+
+
+def _fill_int(series):
+    return series.fillna(0).astype('int64')
+
+
+def visit_state(appt, providers=PROVIDERS):
+    """
+    Aggregates cleaned appointment rows per patient
+
+    Parameters:
+        appt: output of Transform.clean_appts
+        providers: list of ProvNums, bit i of the bitmask is set when providers[i] saw the patient
+
+    Returns:
+        df indexed by PatNum with Frequency, Last Visit and a bitmask of the providers that saw the patient
+    """
+    state = appt.groupby('PatNum')['AptDateTime'].agg(['count', 'max'])
+    state.columns = ['Frequency', 'Last Visit']
+    seen = provider_features(appt, providers)
+    bits = pd.Series((seen.values << np.arange(len(providers))).sum(axis=1), index=seen.index)
+    state['providers'] = _fill_int(bits.reindex(state.index))
+    return state
+
+
+def seen_by(state, providers=PROVIDERS):
+    """
+    Decodes the provider bitmasks of a visit state
+
+    Parameters:
+        state: output of visit_state
+        providers: list of ProvNums the bitmasks were built with
+
+    Returns:
+        df indexed by PatNum with binary seen_by_X columns, as used by Transform.patient_features
+    """
+    bits = (state['providers'].values[:, None] >> np.arange(len(providers))) & 1
+    return pd.DataFrame(bits, index=state.index, columns=[f'seen_by_{prov}' for prov in providers])
+
+
+def bitmask_providers(transform):
+    """
+    Checks that a Transform's provider features can be kept as bitmasks
+
+    Parameters:
+        transform: Transform instance
+
+    Returns:
+        The transform's list of ProvNums
+    """
+    if transform.providers is None or transform.provider_visits:
+        raise ValueError('per patient provider bitmasks need an explicit provider list and no visit counts')
+    return list(transform.providers)
+
+
+def combine_visits(left, right):
+    """
+    Folds two visit states together
+
+    Parameters:
+        left, right: outputs of visit_state
+
+    Returns:
+        Visit state covering the appointments of both inputs
+    """
+    index = left.index.union(right.index)
+    left, right = left.reindex(index), right.reindex(index)
+    state = pd.DataFrame(index=index.rename('PatNum'))
+    state['Frequency'] = _fill_int(left['Frequency']) + _fill_int(right['Frequency'])
+    left_last, right_last = pd.to_datetime(left['Last Visit']), pd.to_datetime(right['Last Visit'])
+    last = left_last.fillna(right_last)
+    state['Last Visit'] = last.where(~(right_last > last), right_last)
+    state['providers'] = _fill_int(left['providers']) | _fill_int(right['providers'])
+    return state
+
+
+def pay_state(pay, claims):
+    """
+    Aggregates cleaned payment and claims rows per patient
+
+    Parameters:
+        pay: output of Transform.clean_payments
+        claims: output of Transform.clean_claims
+
+    Returns:
+        df indexed by PatNum with summed PayAmt, InsPayAmt and the number of rows behind each sum
+    """
+    state = pd.concat([pay.groupby('PatNum')['PayAmt'].agg(['sum', 'size']),
+                       claims.groupby('PatNum')['InsPayAmt'].agg(['sum', 'size'])], axis=1)
+    state.columns = ['PayAmt', 'n_pay', 'InsPayAmt', 'n_claims']
+    state = state.fillna(0)
+    state.index.name = 'PatNum'
+    state[['n_pay', 'n_claims']] = state[['n_pay', 'n_claims']].astype('int64')
+    return state
+
+
+def combine_pay(left, right):
+    """
+    Folds two payment states together
+
+    Parameters:
+        left, right: outputs of pay_state
+
+    Returns:
+        Payment state covering the rows of both inputs
+    """
+    index = left.index.union(right.index)
+    left, right = left.reindex(index, fill_value=0), right.reindex(index, fill_value=0)
+    state = left.fillna(0) + right.fillna(0)
+    state.index.name = 'PatNum'
+    state[['n_pay', 'n_claims']] = state[['n_pay', 'n_claims']].astype('int64')
+    return state
+
+
+class PatientFeatureStore:
+    """
+    Incremental per patient aggregate state for the pay and patient transforms.
+
+    The store keeps appointment counts, latest appointment dates, provider bitmasks and summed PayAmt/InsPayAmt per
+    PatNum for every row dated on or before a watermark day.  Each update folds in only the rows dated after the
+    watermark, while rows dated after the new watermark (e.g. scheduled appointments) or without a date are kept in
+    a small tail that is rebuilt on every update.  Rows are assumed to be append-only: edits to rows already folded
+    in (e.g. an appointment cancelled after the fact) are only picked up by a rebuild.
+    """
+
+    def __init__(self, store_dir='../data/features', transform=None):
+        self.store_dir = store_dir
+        self.transform = transform or Transform()
+        self.providers = bitmask_providers(self.transform)
+        if self.transform.lifetime_features:
+            raise ValueError('the feature store keeps no payment dates, lifetime features need a full Transform')
+        os.makedirs(store_dir, exist_ok=True)
+        self._meta_path = os.path.join(store_dir, 'watermark.json')
+
+    def _path(self, name):
+        return os.path.join(self.store_dir, f'{name}.feather')
+
+    def _load(self, name):
+        return read_artifact(self._path(name)).set_index('PatNum')
+
+    def _store(self, name, df):
+        write_artifact(df.reset_index(), self._path(name))
+
+    @property
+    def watermark(self):
+        """
+        Last day folded into the stored state, None if the store is empty
+        """
+        if not os.path.exists(self._meta_path):
+            return None
+        with open(self._meta_path) as file:
+            meta = json.load(file)
+        if meta['providers'] != self.providers:
+            return None
+        return pd.Timestamp(meta['watermark'])
+
+    def update(self, data_dir, cutoff=None):
+        """
+        Folds the rows dated after the stored watermark and up to cutoff into the stored state.  The csv exports
+        carry no row order to seek by, so every update still reads the full payment, claims and appt exports and
+        windows the rows on their raw date strings; only cleaning, date parsing and the per patient aggregation
+        are limited to the new rows and the tail.
+
+        Parameters:
+            data_dir: directory holding the payment, claims and appt exports
+            cutoff: last complete day of data, defaults to yesterday
+
+        Returns:
+            The new watermark
+        """
+        cutoff = (pd.Timestamp.now() - pd.Timedelta(days=1)) if cutoff is None else pd.Timestamp(cutoff)
+        cutoff = cutoff.normalize()
+        watermark = self.watermark
+        if watermark is not None and cutoff < watermark:
+            raise ValueError(f'cutoff {cutoff.date()} is before the stored watermark {watermark.date()}')
+
+        paths = raw_paths(data_dir)
+        t = self.transform
+        appt, appt_tail = _window(t.read_appts(paths['appt']), DATE_COLS['appt'], watermark, cutoff)
+        pay, pay_tail = _window(t.read_payments(paths['payment']), DATE_COLS['payment'], watermark, cutoff)
+        claims, claims_tail = _window(t.read_claims(paths['claims']), DATE_COLS['claims'], watermark, cutoff)
+
+        visits = visit_state(t.clean_appts(appt), self.providers)
+        pays = pay_state(t.clean_payments(pay), t.clean_claims(claims))
+        if watermark is not None:
+            visits = combine_visits(self._load('visits'), visits)
+            pays = combine_pay(self._load('pay'), pays)
+
+        self._store('visits', visits)
+        self._store('pay', pays)
+        self._store('visits_tail', visit_state(t.clean_appts(appt_tail), self.providers))
+        self._store('pay_tail', pay_state(t.clean_payments(pay_tail), t.clean_claims(claims_tail)))
+        with open(self._meta_path, 'w') as file:
+            json.dump({'watermark': cutoff.strftime('%Y-%m-%d'), 'providers': self.providers}, file)
+        return cutoff
+
+    def pay_transform(self):
+        """
+        Equivalent of Transform.pay_transform as of the last update
+
+        Returns:
+            Table indexed by PatNum with Total of all patient payments over course of entire patient life
+        """
+        state = combine_pay(self._load('pay'), self._load('pay_tail'))
+        return self.transform.pay_totals(state[['PayAmt', 'InsPayAmt']])
+
+    def patient_transform(self, pat_filepath, now=None):
+        """
+        Equivalent of Transform.patient_transform as of the last update, only the patient table is re-read and
+        age and Recency are recomputed from the stored dates
+
+        Parameters:
+            pat_filepath: filepath to patient table
+            now: reference time for age and Recency, defaults to the current time
+
+        Returns:
+            Merged DataFrame of appt and patient tables for use with model for predictions and contact list
+        """
+        state = combine_visits(self._load('visits'), self._load('visits_tail'))
+        pat = self.transform.read_patients(pat_filepath)
+        return self.transform.patient_features(pat, state[['Frequency', 'Last Visit']], seen_by(state, self.providers),
+                                               now=now)
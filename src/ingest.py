@@ -0,0 +1,118 @@
+import os
+
+import pandas as pd
+
+from feature_store import visit_state, combine_visits, seen_by, bitmask_providers
+from profiling import profiled
+from transform_data import Transform, read_csv_chunks, pay_aggregates, PAY_COLS, CLAIMS_COLS, APPT_COLS
+
+
+def write_quarantine(filepath, bad_lines, quarantine_path):
+    """
+    Copies the header and the malformed lines of a csv into a quarantine file
+
+    Parameters:
+        filepath: path to the csv
+        bad_lines: 1-based line numbers of the malformed lines
+        quarantine_path: destination file
+    """
+    wanted = set(bad_lines)
+    with open(filepath) as source, open(quarantine_path, 'w') as quarantine:
+        for number, line in enumerate(source, 1):
+            if number == 1 or number in wanted:
+                quarantine.write(line)
+
+
+def combine_pay_aggregates(left, right):
+    """
+    Folds two payment aggregates together
+
+    Parameters:
+        left, right: outputs of transform_data.pay_aggregates, either may be None
+
+    Returns:
+        Payment aggregate covering the rows of both inputs
+    """
+    if left is None or right is None:
+        return right if left is None else left
+    folds = {'PayAmt': 'sum', 'InsPayAmt': 'sum', 'n_pay': 'sum', 'n_claims': 'sum', 'First Pay': 'min',
+             'Last Pay': 'max', 'Spend12m': 'sum'}
+    both = pd.concat([left, right])
+    return both.groupby(level=0).agg({col: fold for col, fold in folds.items() if col in both})
+
+
+class StreamingTransform(Transform):
+    """
+    Transform that reads the payment, claims and appt tables in fixed size chunks and folds every chunk into per
+    patient aggregates as it arrives, so peak memory depends on chunksize and the number of patients rather than on
+    the size of the tables.  Malformed lines are skipped and copied to <quarantine_dir>/<table>.csv.  Provider
+    features are folded as bitmasks, so an explicit provider list is required.
+    """
+
+    def __init__(self, chunksize=250000, quarantine_dir='../data/quarantine', **kwargs):
+        super().__init__(**kwargs)
+        self.chunksize = chunksize
+        self.quarantine_dir = quarantine_dir
+        self.quarantined = {}
+
+    def read_chunks(self, filepath, usecols, table):
+        """
+        Reads a raw table in chunks, quarantining its malformed lines once it has been read
+
+        Parameters:
+            filepath: path to the raw table
+            usecols: columns to read
+            table: table name, used for the quarantine file
+
+        Returns:
+            Generator of DataFrame chunks
+        """
+        bad_lines = []
+        yield from read_csv_chunks(filepath, usecols, self.chunksize, bad_lines, self.read_dtypes(table))
+        self.quarantined[table] = bad_lines
+        if bad_lines and self.quarantine_dir is not None:
+            os.makedirs(self.quarantine_dir, exist_ok=True)
+            write_quarantine(filepath, bad_lines, os.path.join(self.quarantine_dir, f'{table}.csv'))
+
+    @profiled()
+    def aggregate_chunks(self, chunks, aggregate, state=None):
+        """
+        Folds the payment aggregates of every chunk into state
+
+        Parameters:
+            chunks: generator of raw chunks
+            aggregate: function returning the pay_aggregates of a raw chunk
+            state: payment aggregate to fold into, None to start empty
+
+        Returns:
+            Payment aggregate of state and every chunk, None if both are empty
+        """
+        for chunk in chunks:
+            state = combine_pay_aggregates(state, aggregate(chunk))
+        return state
+
+    @profiled()
+    def pay_transform(self, pay_filepath, claims_filepath, now=None):
+        now = pd.to_datetime('now') if now is None else pd.to_datetime(now)
+
+        def aggregate(**tables):
+            return pay_aggregates(now=now, dated=self.lifetime_features, **tables)
+        state = self.aggregate_chunks(self.read_chunks(pay_filepath, PAY_COLS, 'payment'),
+                                      lambda chunk: aggregate(pay=self.clean_payments(chunk)))
+        state = self.aggregate_chunks(self.read_chunks(claims_filepath, CLAIMS_COLS, 'claims'),
+                                      lambda chunk: aggregate(claims=self.clean_claims(chunk)), state)
+        if state is None:
+            raise ValueError(f'no payment or claims rows in {pay_filepath} and {claims_filepath}')
+        return self.pay_totals(state, now=now)
+
+    @profiled()
+    def patient_transform(self, appt_filepath, pat_filepath, now=None):
+        providers = bitmask_providers(self)
+        state = None
+        for chunk in self.read_chunks(appt_filepath, APPT_COLS, 'appt'):
+            partial = visit_state(self.clean_appts(chunk), providers)
+            state = partial if state is None else combine_visits(state, partial)
+        if state is None:
+            raise ValueError(f'no appointment rows in {appt_filepath}')
+        pat = self.read_patients(pat_filepath)
+        return self.patient_features(pat, state[['Frequency', 'Last Visit']], seen_by(state, providers), now=now)
@@ -1,7 +1,73 @@
-from sklearn.metrics import plot_roc_curve, f1_score, confusion_matrix
+import argparse
+import json
+import os
+import pickle
+
 import numpy as np
+import pandas as pd
+
+from cache import file_digest
+
+# churn threshold used when a model has no threshold file, see save_threshold
+DEFAULT_THRESHOLD = 0.48
+
+# bump whenever the layout of the logistic artifact changes
+LOGISTIC_VERSION = 1
+
+
+def threshold_table(ytest, probas, thresholds=None):
+    '''
+    Confusion counts, precision, recall and F1 for every candidate threshold from a single sort of the probabilities
+    :param ytest: test set labels, 1 for churn
+    :param probas: predicted churn probabilities aligned with ytest
+    :param thresholds: candidate thresholds, a patient is predicted to churn when its probability is >= threshold
+                       (default every distinct probability)
+    :return: pandas DataFrame of threshold, tp, fp, fn, tn, precision, recall and f1 sorted by threshold
+    '''
+    y = np.asarray(ytest).astype(bool)
+    probas = np.asarray(probas, dtype='float64')
+    thresholds = np.unique(probas) if thresholds is None else np.sort(np.asarray(thresholds, dtype='float64'))
+
+    order = np.argsort(-probas)
+    # true positives among the n highest probabilities, for n = 0..len(probas)
+    cum_tp = np.concatenate([[0], np.cumsum(y[order])])
+    predicted = np.searchsorted(-probas[order], -thresholds, side='right')
+    tp = cum_tp[predicted]
+    fp = predicted - tp
+    positives = y.sum()
+    fn = positives - tp
+    tn = len(y) - positives - fp
 
-def thresh_selection(xtest, ytest, classifier, start, stop, step=None):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted > 0, tp / predicted, 0.0)
+        recall = tp / positives if positives else np.zeros(len(tp))
+        f1 = np.where(tp > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+    return pd.DataFrame({'threshold': thresholds, 'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn,
+                         'precision': precision, 'recall': recall, 'f1': f1})
+
+
+def best_threshold(table, objective='f1', min_precision=None, min_recall=None):
+    '''
+    Picks the threshold that maximises an objective
+    :param table: DataFrame returned by threshold_table
+    :param objective: column of table to maximise, or a function of table returning a score per row
+    :param min_precision: only consider thresholds with at least this precision (optional)
+    :param min_recall: only consider thresholds with at least this recall (optional)
+    :return: float, the highest threshold with the best objective value
+    '''
+    candidates = table
+    if min_precision is not None:
+        candidates = candidates[candidates['precision'] >= min_precision]
+    if min_recall is not None:
+        candidates = candidates[candidates['recall'] >= min_recall]
+    if candidates.empty:
+        raise ValueError('no threshold satisfies the precision and recall constraints')
+    scores = np.asarray(objective(candidates) if callable(objective) else candidates[objective])
+    best = np.flatnonzero(scores == np.nanmax(scores))[-1]
+    return float(candidates['threshold'].iloc[best])
+
+
+def thresh_selection(xtest, ytest, classifier, start, stop, step=None, plot=False):
     '''
     Selects best threshold for tuning model for Precision or Recall
     :param xtest: test set data
@@ -10,24 +76,222 @@ def thresh_selection(xtest, ytest, classifier, start, stop, step=None):
     :param start: starting point for thresh value
     :param stop: stopping point for thresh value
     :param step: iterative value between start and stop (optional)
-    :return: prints f1 scores and fp/fn results, also plots roc curve
-    '''
-
-    for thresh in np.arange(start, stop, step):
-        threshold = thresh
-        predicted_proba = classifier.predict_proba(xtest)
-        predicted = (predicted_proba[:, 1] >= threshold).astype('int')
-        print(f'F1 Score at {round(threshold, 2)} prediction threshold: {round(f1_score(ytest, predicted), 2)}')
-        tp, fp, fn, tn = confusion_matrix(ytest, predicted).ravel()
-        print(f'False Positives = {fp}, False Negatives = {fn}\n\n')
-    plot_roc_curve(classifier, xtest, ytest, lw=3)
-    
+    :param plot: also plot the roc curve
+    :return: pandas DataFrame of f1 scores and confusion counts per threshold, see threshold_table
+    '''
+    table = threshold_table(ytest, classifier.predict_proba(xtest)[:, 1], np.arange(start, stop, step))
+    if plot:
+        plot_roc(classifier, xtest, ytest)
+    return table
+
+
+def plot_roc(classifier, xtest, ytest):
+    '''
+    Plots the roc curve of a fitted classifier
+    '''
+    # plot_roc_curve was replaced by RocCurveDisplay in sklearn 1.0
+    try:
+        from sklearn.metrics import RocCurveDisplay
+        return RocCurveDisplay.from_estimator(classifier, xtest, ytest, lw=3)
+    except (ImportError, AttributeError):
+        from sklearn.metrics import plot_roc_curve
+        return plot_roc_curve(classifier, xtest, ytest, lw=3)
+
+
+def threshold_path(model_path):
+    return f'{os.path.splitext(model_path)[0]}.threshold.json'
+
+
+def save_threshold(model_path, threshold, objective='f1'):
+    '''
+    Stores the churn threshold chosen for a model next to it
+    :param model_path: filepath to pickled model
+    :param threshold: threshold from best_threshold
+    :param objective: description of how the threshold was chosen
+    '''
+    with open(threshold_path(model_path), 'w') as file:
+        json.dump({'threshold': float(threshold), 'objective': str(objective)}, file)
+
+
+def load_threshold(model_path, default=DEFAULT_THRESHOLD):
+    '''
+    Loads the churn threshold stored by save_threshold
+    :param model_path: filepath to pickled model
+    :param default: threshold returned when the model has no threshold file
+    :return: float, threshold
+    '''
+    path = threshold_path(model_path)
+    if not os.path.exists(path):
+        return default
+    with open(path) as file:
+        return json.load(file)['threshold']
+
+
+def calibrate_threshold(xtest, ytest, classifier, model_path, objective='f1', **constraints):
+    '''
+    Chooses the threshold of a model on a holdout set and stores it for the dashboard
+    :param xtest: holdout data
+    :param ytest: holdout labels
+    :param classifier: fitted sklearn model saved at model_path
+    :param model_path: filepath to pickled model
+    :param objective: see best_threshold
+    :param constraints: min_precision and/or min_recall, see best_threshold
+    :return: threshold_table of the holdout and the chosen threshold
+    '''
+    table = threshold_table(ytest, classifier.predict_proba(xtest)[:, 1])
+    threshold = best_threshold(table, objective, **constraints)
+    save_threshold(model_path, threshold, objective if not callable(objective) else objective.__name__)
+    return table, threshold
+
+
+def training_path(model_path):
+    return f'{os.path.splitext(model_path)[0]}.train.json'
+
+
+def save_training(model_path, metadata):
+    '''
+    Stores how a model was trained next to it, see train.py
+    :param model_path: filepath to pickled model
+    :param metadata: json serializable dict, its 'transform' entry holds the Transform options of the features
+    '''
+    with open(training_path(model_path), 'w') as file:
+        json.dump(metadata, file, indent=2)
+
+
+def load_training(model_path):
+    '''
+    Loads the metadata stored by save_training
+    :param model_path: filepath to pickled model
+    :return: dict, empty if the model was not trained by train.py
+    '''
+    path = training_path(model_path)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+
 def odds_to_prob(log_odds):
     '''
-    Given log odds returns probability
-    :param log_odds: float or int
-    :returns : float, probability
+    Given log odds returns probability, without overflow for large positive or negative log odds
+    :param log_odds: float, int or array
+    :returns : float or array, probability
     '''
-    return np.exp(log_odds)/(1+np.exp(log_odds))
+    log_odds = np.asarray(log_odds, dtype='float64')
+    odds = np.exp(-np.abs(log_odds))
+    return np.where(log_odds >= 0, 1 / (1 + odds), odds / (1 + odds))[()]
+
+
+def logistic_paths(model_path):
+    base = os.path.splitext(model_path)[0]
+    return f'{base}.logistic.npy', f'{base}.logistic.json'
+
+
+def export_logistic(model, model_path, feature_names=None):
+    '''
+    Exports a fitted logistic regression, optionally behind a StandardScaler in a Pipeline, to a small artifact
+    scored by LogisticScorer without sklearn: <model>.logistic.npy holds the coefficient, mean and scale rows and
+    <model>.logistic.json the intercept, feature order, threshold and the digest of the pickled model
+    :param model: fitted LogisticRegression or Pipeline of StandardScaler and LogisticRegression
+    :param model_path: filepath the model is pickled at, the artifact is written next to it
+    :param feature_names: feature order, defaults to the feature_names_in_ the model was fitted with
+    :return: paths of the array and metadata files
+    '''
+    steps = [step for _, step in model.steps] if hasattr(model, 'steps') else [model]
+    *scalers, classifier = steps
+    if len(scalers) > 1 or any(type(scaler).__name__ != 'StandardScaler' for scaler in scalers):
+        raise ValueError('only a LogisticRegression behind at most one StandardScaler can be exported')
+    if classifier.coef_.shape[0] != 1:
+        raise ValueError('only binary logistic regressions can be exported')
+    if feature_names is None:
+        feature_names = getattr(model, 'feature_names_in_', None)
+        if feature_names is None:
+            raise ValueError('feature_names is required for models fitted without column names')
+
+    coef = classifier.coef_[0]
+    mean, scale = np.zeros_like(coef), np.ones_like(coef)
+    if scalers:
+        mean = scalers[0].mean_ if scalers[0].mean_ is not None else mean
+        scale = scalers[0].scale_ if scalers[0].scale_ is not None else scale
+    if len(feature_names) != len(coef):
+        raise ValueError(f'{len(feature_names)} feature names for {len(coef)} coefficients')
+
+    array_path, meta_path = logistic_paths(model_path)
+    np.save(array_path, np.vstack([coef, mean, scale]).astype('float64'))
+    with open(meta_path, 'w') as file:
+        json.dump({'version': LOGISTIC_VERSION, 'features': list(map(str, feature_names)),
+                   'intercept': float(classifier.intercept_[0]), 'threshold': load_threshold(model_path),
+                   'model_digest': file_digest(model_path)}, file, indent=2)
+    return array_path, meta_path
+
+
+class LogisticScorer:
+    '''
+    Pure NumPy churn scorer for an artifact written by export_logistic, a drop in for the pickled model's
+    predict_proba.  The coefficients are memory mapped.
+    '''
+
+    def __init__(self, model_path):
+        array_path, meta_path = logistic_paths(model_path)
+        with open(meta_path) as file:
+            meta = json.load(file)
+        if meta['version'] != LOGISTIC_VERSION:
+            raise ValueError(f'{meta_path} has artifact version {meta["version"]}, expected {LOGISTIC_VERSION}')
+        self.features = meta['features']
+        self.intercept = meta['intercept']
+        self.threshold = meta['threshold']
+        self.model_digest = meta['model_digest']
+        self.coef, self.mean, self.scale = np.load(array_path, mmap_mode='r')
+
+    def check_features(self, features):
+        '''
+        Raises ValueError unless the columns of features are the model's features in the model's order
+        '''
+        columns = list(features.columns)
+        if columns != self.features:
+            missing = [col for col in self.features if col not in columns]
+            extra = [col for col in columns if col not in self.features]
+            raise ValueError(f'feature columns do not match the model: missing {missing}, unexpected {extra}, '
+                             f'expected order {self.features}')
+
+    def decision_function(self, features):
+        self.check_features(features)
+        return ((features.to_numpy(dtype='float64') - self.mean) / self.scale) @ self.coef + self.intercept
+
+    def predict_proba(self, features):
+        '''
+        :param features: df of model features, e.g. the test set from app.load_data
+        :return: array of shape (rows, 2) of the probabilities of no churn and churn, as sklearn
+        '''
+        churn = odds_to_prob(self.decision_function(features))
+        return np.column_stack([1 - churn, churn])
+
+
+def load_logistic(model_path):
+    '''
+    Loads the lightweight artifact exported from a pickled model
+    :param model_path: filepath to pickled model
+    :return: LogisticScorer, or None if there is no artifact or it was exported from a different model file
+    '''
+    array_path, meta_path = logistic_paths(model_path)
+    if not (os.path.exists(array_path) and os.path.exists(meta_path)):
+        return None
+    scorer = LogisticScorer(model_path)
+    if os.path.exists(model_path) and scorer.model_digest != file_digest(model_path):
+        return None
+    return scorer
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Exports a pickled logistic regression for LogisticScorer')
+    parser.add_argument('model', nargs='?', default='bestLRmodel.pkl', help='pickled model')
+    parser.add_argument('--features', nargs='+', help='feature order, if the model was fitted without column names')
+    args = parser.parse_args(argv)
+
+    with open(args.model, 'rb') as file:
+        model = pickle.load(file)
+    print('wrote', *export_logistic(model, args.model, args.features))
+
 
-    
\ No newline at end of file
+if __name__ == '__main__':
+    main()
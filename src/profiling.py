@@ -0,0 +1,169 @@
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+# ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+# environment variables that enable profiling at import, e.g. for the dashboard or the nightly jobs
+LOG_ENV = 'DENTAL_PROFILE_LOG'
+MEMORY_ENV = 'DENTAL_PROFILE_MEMORY'
+CPROFILE_ENV = 'DENTAL_PROFILE_CPROFILE'
+
+_config = None
+_local = threading.local()
+_lock = threading.Lock()
+
+
+def enable(log_path, memory=False, cprofile_dir=None):
+    """
+    Starts recording every profiled stage as a json line appended to log_path
+
+    Parameters:
+        log_path: json lines file the records are appended to
+        memory: also record the peak Python heap of every stage with tracemalloc, which slows the stages down
+        cprofile_dir: directory a cProfile dump of every outermost stage is written to, None to disable
+    """
+    global _config
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if cprofile_dir is not None:
+        os.makedirs(cprofile_dir, exist_ok=True)
+    _config = {'log_path': log_path, 'memory': memory, 'cprofile_dir': cprofile_dir}
+
+
+def disable():
+    global _config
+    if _config is not None and _config['memory']:
+        tracemalloc.stop()
+    _config = None
+
+
+def enabled():
+    return _config is not None
+
+
+def _rows(obj):
+    if isinstance(obj, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        counts = [_rows(item) for item in obj]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def _write(record):
+    with _lock, open(_config['log_path'], 'a') as file:
+        file.write(json.dumps(record) + '\n')
+
+
+def _run(stage, func, args, kwargs):
+    config = _config
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    frame = {'peak': 0}
+    if config['memory']:
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+        start_traced = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    profiler = None
+    if config['cprofile_dir'] is not None and not stack:
+        profiler = cProfile.Profile()
+
+    stack.append(frame)
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        if profiler is not None:
+            result = profiler.runcall(func, *args, **kwargs)
+        else:
+            result = func(*args, **kwargs)
+    finally:
+        wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+        stack.pop()
+
+    record = {'stage': stage, 'depth': len(stack), 'pid': os.getpid(), 'start': time.time() - wall,
+              'wall_s': wall, 'cpu_s': cpu, 'rows_in': _rows([arg for arg in args if _rows(arg) is not None]),
+              'rows_out': _rows(result),
+              'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT / 2 ** 20}
+    if config['memory']:
+        # nested stages reset the tracemalloc peak, so they hand their peak up to the enclosing stage
+        peak = max(tracemalloc.get_traced_memory()[1], frame['peak'])
+        record['peak_heap_mb'] = (peak - start_traced) / 2 ** 20
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+    if profiler is not None:
+        dump = os.path.join(config['cprofile_dir'], f'{stage}-{os.getpid()}-{int(time.time() * 1000)}.prof')
+        profiler.dump_stats(dump)
+        record['cprofile'] = dump
+    _write(record)
+    return result
+
+
+def profiled(stage=None):
+    """
+    Decorator recording wall time, CPU time, rows in and out and peak memory of every call while profiling is
+    enabled, see enable.  When disabled the call goes straight through.
+
+    Parameters:
+        stage: name of the stage in the log, defaults to the function's qualified name
+
+    Returns:
+        Decorator
+    """
+    def decorate(func):
+        name = stage or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _config is None:
+                return func(*args, **kwargs)
+            return _run(name, func, args, kwargs)
+        return wrapper
+    return decorate
+
+
+def read_log(log_path):
+    """
+    Loads a profiling log
+
+    Parameters:
+        log_path: json lines file written while profiling was enabled
+
+    Returns:
+        df with one row per profiled call
+    """
+    return pd.read_json(log_path, lines=True)
+
+
+def summarize(log_path):
+    """
+    Totals of a profiling log per stage
+
+    Parameters:
+        log_path: json lines file written while profiling was enabled
+
+    Returns:
+        df of calls, total and mean wall time, total CPU time and largest row counts per stage, slowest first
+    """
+    log = read_log(log_path)
+    summary = log.groupby('stage').agg(calls=('wall_s', 'size'), wall_s=('wall_s', 'sum'),
+                                       mean_wall_s=('wall_s', 'mean'), cpu_s=('cpu_s', 'sum'),
+                                       rows_in=('rows_in', 'max'), rows_out=('rows_out', 'max'),
+                                       peak_rss_mb=('peak_rss_mb', 'max'))
+    return summary.sort_values('wall_s', ascending=False)
+
+
+if os.environ.get(LOG_ENV):
+    enable(os.environ[LOG_ENV], memory=bool(os.environ.get(MEMORY_ENV)), cprofile_dir=os.environ.get(CPROFILE_ENV))
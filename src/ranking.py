@@ -0,0 +1,34 @@
+import numpy as np
+
+
+def top_k(values, k, ids, largest=True):
+    """
+    Selects the positions of the k highest (or lowest) values with a partial sort, ties are broken by ascending id
+    so the selection does not depend on row order.  NaN values are ranked last.
+
+    Parameters:
+        values: 1d array of scores or probabilities
+        k: number of positions to return, None for a full ranking
+        ids: 1d array of unique ids (e.g. PatNum) aligned with values, used to break ties
+        largest: rank the highest values first, otherwise the lowest
+
+    Returns:
+        Array of at most k positions into values, in ranked order
+    """
+    keys = np.asarray(values, dtype='float64')
+    keys = -keys if largest else keys.copy()
+    keys[np.isnan(keys)] = np.inf
+    ids = np.asarray(ids)
+
+    n = len(keys)
+    if k is None or k >= n:
+        candidates = np.arange(n)
+    elif k <= 0:
+        return np.array([], dtype='int64')
+    else:
+        # everything tied with the k-th key is a candidate so ties are resolved by id, not by partition order
+        kth = np.partition(keys, k - 1)[k - 1]
+        candidates = np.flatnonzero(keys <= kth)
+
+    order = np.lexsort((ids[candidates], keys[candidates]))
+    return candidates[order[:k]]
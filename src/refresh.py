@@ -0,0 +1,202 @@
+import argparse
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from profiling import profiled
+from score import build, write_snapshot, latest_snapshot, load_snapshot, snapshot_time
+from transform_data import raw_paths
+
+# scores and contact list of one snapshot, with the time the raw exports were read at
+Snapshot = namedtuple('Snapshot', ['name', 'as_of', 'scores', 'contact'])
+
+
+@profiled()
+def rebuild(data_dir, model_path, out_dir, cache_dir='../data/cache'):
+    """
+    Runs the pipeline, scores the churn window and writes a snapshot, run in the refresh worker process
+
+    Parameters:
+        data_dir: directory holding the raw exports
+        model_path: filepath to pickled model
+        out_dir: directory the snapshots are written to
+        cache_dir: directory of the Transform stage cache
+
+    Returns:
+        Name of the snapshot
+    """
+    # stamp the snapshot with the start of the run, so exports replaced while it runs trigger another rebuild
+    as_of = pd.Timestamp.now()
+    scores, contact, fingerprint = build(data_dir, model_path, cache_dir)
+    return write_snapshot(scores, contact, fingerprint, out_dir, as_of=as_of)
+
+
+class Refresher:
+    """
+    Serves the latest score snapshot while rebuilding it in the background.  A watcher thread polls the raw
+    exports and the model, and once they are newer than the snapshot (or the snapshot is older than max_age, since
+    Recency moves every day) runs rebuild in a worker process, so the pipeline neither blocks nor holds the GIL of
+    the dashboard.  The new snapshot is swapped in with a single assignment when it has been written, readers keep
+    the previous one until then.
+    """
+
+    def __init__(self, data_dir='../data/raw', model_path='bestLRmodel.pkl', out_dir='../data/scores',
+                 cache_dir='../data/cache', interval=60, max_age=24 * 3600, settle=30):
+        """
+        Parameters:
+            data_dir: directory holding the raw exports
+            model_path: filepath to pickled model
+            out_dir: directory the snapshots are written to
+            cache_dir: directory of the Transform stage cache
+            interval: seconds between checks for new exports
+            max_age: seconds after which the snapshot is rebuilt even if nothing changed
+            settle: seconds the exports have to stay unchanged before a rebuild, so partly copied exports are
+                    not read
+        """
+        self.data_dir = data_dir
+        self.model_path = model_path
+        self.out_dir = out_dir
+        self.cache_dir = cache_dir
+        self.interval = interval
+        self.max_age = max_age
+        self.settle = settle
+        self.error = None
+        self.last_check = None
+        self._current = None
+        self._future = None
+        self._pool = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self.load()
+
+    @property
+    def current(self):
+        """
+        Latest Snapshot, or None until the first snapshot has been written
+        """
+        return self._current
+
+    @property
+    def refreshing(self):
+        return self._future is not None and not self._future.done()
+
+    def load(self):
+        """
+        Swaps in the latest snapshot on disk if it is newer than the current one
+        """
+        name = latest_snapshot(self.out_dir)
+        if name is None or (self._current is not None and self._current.name == name):
+            return
+        scores, contact = load_snapshot(self.out_dir, name)
+        self._current = Snapshot(name, snapshot_time(name), scores, contact)
+
+    def newest_input(self):
+        """
+        Returns:
+            Modification time of the newest raw export or model, as seconds since the epoch
+        """
+        paths = list(raw_paths(self.data_dir).values()) + [self.model_path]
+        return max([os.path.getmtime(path) for path in paths if os.path.exists(path)], default=0)
+
+    def stale(self, now=None):
+        """
+        Parameters:
+            now: seconds since the epoch, defaults to the current time
+
+        Returns:
+            True if the snapshot should be rebuilt
+        """
+        now = time.time() if now is None else now
+        newest = self.newest_input()
+        if now - newest < self.settle:
+            return False
+        if self._current is None:
+            return True
+        # snapshot names are stamped in local time
+        as_of = time.mktime(self._current.as_of.timetuple())
+        return newest > as_of or now - as_of > self.max_age
+
+    def check(self):
+        """
+        Collects a finished rebuild and starts a new one if the snapshot is stale
+        """
+        self.last_check = pd.Timestamp.now()
+        if self._future is not None:
+            if not self._future.done():
+                return
+            try:
+                self._future.result()
+                self.error = None
+            except Exception:
+                self.error = traceback.format_exc()
+            self._future = None
+            self.load()
+        if self.stale():
+            self._future = self._pool.submit(rebuild, self.data_dir, self.model_path, self.out_dir, self.cache_dir)
+            self._future.add_done_callback(lambda future: self._wake.set())
+
+    def _watch(self):
+        while not self._stopped.is_set():
+            try:
+                self.check()
+            except Exception:
+                self.error = traceback.format_exc()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        """
+        Starts the watcher thread and the worker process, returns self
+        """
+        if self._thread is None:
+            # spawn, forking a process that runs threads can deadlock the child
+            self._pool = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'))
+            self._thread = threading.Thread(target=self._watch, name='score-refresh', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._pool.shutdown(wait=False)
+            self._thread = self._pool = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Keeps the score snapshot up to date with the raw exports')
+    parser.add_argument('--data-dir', default='../data/raw', help='directory holding the raw exports')
+    parser.add_argument('--model', default='bestLRmodel.pkl', help='pickled model')
+    parser.add_argument('--out-dir', default='../data/scores', help='directory the snapshots are written to')
+    parser.add_argument('--cache-dir', default='../data/cache', help='directory of the Transform stage cache')
+    parser.add_argument('--interval', type=float, default=60, help='seconds between checks for new exports')
+    parser.add_argument('--max-age', type=float, default=24 * 3600, help='seconds before a snapshot is rebuilt')
+    args = parser.parse_args(argv)
+
+    refresher = Refresher(args.data_dir, args.model, args.out_dir, args.cache_dir, args.interval, args.max_age)
+    refresher.start()
+    served, error = None, None
+    try:
+        while True:
+            time.sleep(args.interval)
+            current = refresher.current
+            if current is not None and current.name != served:
+                served = current.name
+                print(f'serving snapshot {served} as of {current.as_of}')
+            if refresher.error != error:
+                error = refresher.error
+                print(error or 'rebuild recovered')
+    except KeyboardInterrupt:
+        refresher.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from cache import CachedTransform, write_artifact
+from transform_data import Transform
+
+# frames produced for every practice
+OUTPUTS = ['for_model', 'contact']
+
+
+def load_manifest(filepath):
+    """
+    Reads a manifest of practice exports, either a json object of practice id to directory or a csv with
+    practice_id and data_dir columns.  Relative directories are resolved against the manifest's directory.
+
+    Parameters:
+        filepath: path to the manifest
+
+    Returns:
+        Dict of practice id to directory holding its raw exports
+    """
+    if filepath.endswith('.json'):
+        with open(filepath) as file:
+            manifest = json.load(file)
+    else:
+        rows = pd.read_csv(filepath, dtype=str)
+        manifest = dict(zip(rows['practice_id'], rows['data_dir']))
+    base_dir = os.path.dirname(os.path.abspath(filepath))
+    return {practice_id: os.path.join(base_dir, data_dir) for practice_id, data_dir in manifest.items()}
+
+
+def run_practice(practice_id, data_dir, cache_dir=None, out_dir=None, now=None):
+    """
+    Runs the Transform pipeline for one practice
+
+    Parameters:
+        practice_id: id of the practice
+        data_dir: directory holding the practice's raw exports
+        cache_dir: directory of a shared Transform stage cache, None to disable caching
+        out_dir: directory the practice's frames are written to as <out_dir>/<practice_id>/<output>.feather
+        now: reference time for age and Recency, defaults to the current time
+
+    Returns:
+        Dict of output name to frame, see OUTPUTS
+    """
+    t = Transform() if cache_dir is None else CachedTransform(cache_dir)
+    for_model, contact = t.data_split(t.run(data_dir, now=now))
+    results = {'for_model': for_model, 'contact': t.contact_transform(contact)}
+    if out_dir is not None:
+        practice_dir = os.path.join(out_dir, str(practice_id))
+        os.makedirs(practice_dir, exist_ok=True)
+        for name, df in results.items():
+            write_artifact(df, os.path.join(practice_dir, f'{name}.feather'))
+    return results
+
+
+def run_practices(manifest, workers=None, cache_dir=None, out_dir=None, now=None):
+    """
+    Runs the Transform pipeline for several practices in a process pool.  A practice that fails is reported in the
+    returned errors and does not stop the others.
+
+    Parameters:
+        manifest: dict of practice id to directory holding its raw exports, see load_manifest
+        workers: number of worker processes, defaults to the number of CPUs
+        cache_dir, out_dir, now: see run_practice, combined frames are written as <out_dir>/<output>.feather
+
+    Returns:
+        Dict of practice id to its outputs, dict of output name to the combined frame of all practices with a
+        practice_id column, and dict of practice id to the traceback of failed practices
+    """
+    results, errors = {}, {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_practice, practice_id, data_dir, cache_dir, out_dir, now): practice_id
+                   for practice_id, data_dir in manifest.items()}
+        for future in as_completed(futures):
+            practice_id = futures[future]
+            try:
+                results[practice_id] = future.result()
+            except Exception:
+                errors[practice_id] = traceback.format_exc()
+
+    combined = {}
+    for name in OUTPUTS:
+        frames = [results[practice_id][name].assign(practice_id=practice_id)
+                  for practice_id in manifest if practice_id in results]
+        if frames:
+            df = pd.concat(frames, ignore_index=True)
+            combined[name] = df[['practice_id'] + [col for col in df.columns if col != 'practice_id']]
+            if out_dir is not None:
+                write_artifact(combined[name], os.path.join(out_dir, f'{name}.feather'))
+    return results, combined, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the Transform pipeline for every practice in a manifest')
+    parser.add_argument('manifest', help='json or csv manifest of practice ids and export directories')
+    parser.add_argument('--out-dir', default='../data/practices', help='directory the outputs are written to')
+    parser.add_argument('--cache-dir', help='shared Transform stage cache, caching is disabled if omitted')
+    parser.add_argument('--workers', type=int, help='number of worker processes, defaults to the number of CPUs')
+    args = parser.parse_args(argv)
+
+    manifest = load_manifest(args.manifest)
+    results, combined, errors = run_practices(manifest, args.workers, args.cache_dir, args.out_dir)
+    for practice_id in manifest:
+        if practice_id in results:
+            counts = ', '.join(f'{len(df)} {name}' for name, df in results[practice_id].items())
+            print(f'{practice_id}: {counts}')
+        else:
+            print(f'{practice_id}: FAILED\n{errors[practice_id]}')
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
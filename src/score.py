@@ -0,0 +1,232 @@
+import argparse
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from cache import CachedTransform, file_digest, read_artifact, write_artifact
+from model_functions import load_logistic, load_training, DEFAULT_THRESHOLD
+from profiling import profiled
+from ranking import top_k
+
+# bump whenever the layout of the scores artifacts changes
+SCORES_VERSION = 1
+
+# columns dropped from the for_model frame before scoring
+DROP_COLUMNS = ['PatNum', 'FName', 'Recency']
+
+# lifetime features that leak the churn label: PayRecency trails Recency by the payment lag and PayTenure runs up to
+# the same reference time, so neither is trained on or scored
+LABEL_PROXIES = ['PayTenure', 'PayRecency']
+
+# columns kept alongside the probabilities for the priority list
+SCORE_COLS = ['PatNum', 'FName', 'Tenure', 'Frequency', 'Recency']
+
+# columns kept from the contact window for contact_transform
+CONTACT_COLS = ['PatNum', 'FName', 'Recency', 'Tenure', 'Total', 'Frequency']
+
+
+@profiled()
+def load_model(filepath):
+    """
+    Loads pickled model for use with predictions
+
+    Parameters:
+        filepath: filepath to pickled model
+
+    Returns:
+        LogisticScorer if the model has been exported with model_functions.export_logistic, otherwise the
+        unpickled model
+    """
+    scorer = load_logistic(filepath)
+    if scorer is not None:
+        return scorer
+    with open(filepath, 'rb') as file:
+        return pickle.load(file)
+
+
+@profiled()
+def predict_in_chunks(model, features, chunk_size=100000):
+    """
+    Predicts churn probabilities a chunk of rows at a time, every chunk is cast back to float64 so compact
+    feature dtypes score exactly like the frames the model was trained on
+
+    Parameters:
+        model: fitted binary classifier with predict_proba
+        features: df of model features
+        chunk_size: number of rows scored per predict_proba call
+
+    Returns:
+        1d array of churn probabilities
+    """
+    probas = [model.predict_proba(features.iloc[start:start + chunk_size].astype('float64'))[:, 1]
+              for start in range(0, len(features), chunk_size)]
+    return np.concatenate(probas) if probas else np.array([], dtype='float64')
+
+
+def model_features(df):
+    """
+    Parameters:
+        df: for_model df from Transform.data_split
+
+    Returns:
+        df without DROP_COLUMNS and LABEL_PROXIES, the columns models are trained on and scored with
+    """
+    return df.drop(DROP_COLUMNS + [col for col in LABEL_PROXIES if col in df.columns], axis=1)
+
+
+@profiled()
+def score(for_model, model, fingerprint, chunk_size=100000):
+    """
+    Scores every patient in the churn window
+
+    Parameters:
+        for_model: for_model df from Transform.data_split
+        model: fitted binary classifier with predict_proba
+        fingerprint: identifier of the model, stored with every score
+        chunk_size: number of rows scored per predict_proba call
+
+    Returns:
+        df of SCORE_COLS, probability and model_fingerprint sorted from highest to lowest churn risk
+    """
+    probas = predict_in_chunks(model, model_features(for_model), chunk_size)
+    scores = for_model.loc[:, SCORE_COLS]
+    scores['probability'] = probas
+    scores['model_fingerprint'] = pd.Categorical([fingerprint] * len(scores))
+    scores = scores.sort_values(['probability', 'PatNum'], ascending=[False, True])
+    return scores.reset_index(drop=True)
+
+
+@profiled()
+def priority_list(original_df, predicted_probas, thresh=DEFAULT_THRESHOLD, num_patients=20):
+    """
+    Create patient prioritized contact list to prevent churn
+
+    Parameters:
+        original df:      df to map back to patient contact info, rows aligned with predicted_probas
+        predicted_probas: predicted probabilities for each patients to be sorted highest to lowest for churn (2d array for binary class or 1d array of churn probabilities)
+        thresh:           threshold setting for capturing predicted churn above a certain threshold, see model_functions.load_threshold
+        num_patients:     user input feature to allow setting the number of patients that the receptionist wants to contact each day
+
+    Returns:
+        Prioritized list of potential churn patients for staff to take action on (includes patient contact info)
+    """
+    probas = np.asarray(predicted_probas)
+    probas = probas[:, 1] if probas.ndim == 2 else probas
+    churns = np.flatnonzero(probas >= thresh)
+    priority_patients = churns[top_k(probas[churns], num_patients, original_df['PatNum'].values[churns])]
+    patients = original_df.iloc[priority_patients].loc[:, ['PatNum', 'FName', 'Tenure', 'Frequency', 'Recency']]
+    #patients.insert(5, 'Risk Factor', round(priority_patients,1))
+    patients.columns = ['PatNum', 'First Name', 'Tenure', '#_of_Visits', 'Last Visit (days)']#, 'Risk Factor']
+    patients.index = patients.reset_index(drop=True).index + 1
+    return patients
+
+
+@profiled()
+def build(data_dir, model_path, cache_dir='../data/cache', chunk_size=100000):
+    """
+    Runs the Transform pipeline and scores the churn window
+
+    Parameters:
+        data_dir: directory holding the raw exports
+        model_path: filepath to pickled model
+        cache_dir: directory of the Transform stage cache
+        chunk_size: number of rows scored per predict_proba call
+
+    Returns:
+        Sorted scores df, contact window df and the model fingerprint
+    """
+    # build the features with the Transform options the model was trained with, see train.py
+    t = CachedTransform(cache_dir, **load_training(model_path).get('transform', {}))
+    for_model, contact = t.data_split(t.run(data_dir))
+    fingerprint = file_digest(model_path)
+    scores = score(for_model, load_model(model_path), fingerprint, chunk_size)
+    return scores, contact.loc[:, CONTACT_COLS].reset_index(drop=True), fingerprint
+
+
+def write_snapshot(scores, contact, fingerprint, out_dir, as_of=None):
+    """
+    Writes a versioned scores/contact snapshot and points out_dir/LATEST at it
+
+    Parameters:
+        scores: sorted scores df from score
+        contact: contact window df
+        fingerprint: identifier of the model
+        out_dir: directory holding the snapshots
+        as_of: time the raw exports were read, defaults to the current time
+
+    Returns:
+        Name of the snapshot
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    as_of = pd.Timestamp.now() if as_of is None else pd.Timestamp(as_of)
+    name = f'v{SCORES_VERSION}-{as_of:%Y%m%dT%H%M%S}-{fingerprint[:12]}'
+    write_artifact(scores, os.path.join(out_dir, f'{name}-scores.feather'))
+    write_artifact(contact, os.path.join(out_dir, f'{name}-contact.feather'))
+    tmp_path = os.path.join(out_dir, f'LATEST.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as file:
+        file.write(name)
+    os.replace(tmp_path, os.path.join(out_dir, 'LATEST'))
+    return name
+
+
+def latest_snapshot(out_dir):
+    """
+    Parameters:
+        out_dir: directory holding the snapshots
+
+    Returns:
+        Name of the latest snapshot written by write_snapshot, or None if there is no snapshot of the current version
+    """
+    latest = os.path.join(out_dir, 'LATEST')
+    if not os.path.exists(latest):
+        return None
+    with open(latest) as file:
+        name = file.read().strip()
+    return name if name.startswith(f'v{SCORES_VERSION}-') else None
+
+
+def snapshot_time(name):
+    """
+    Returns:
+        Timestamp the raw exports of a snapshot were read at
+    """
+    return pd.to_datetime(name.split('-')[1], format='%Y%m%dT%H%M%S')
+
+
+@profiled()
+def load_snapshot(out_dir, name=None):
+    """
+    Loads a snapshot written by write_snapshot
+
+    Parameters:
+        out_dir: directory holding the snapshots
+        name: snapshot to load, defaults to the latest
+
+    Returns:
+        Sorted scores df and contact window df, or None if there is no snapshot of the current version
+    """
+    name = name or latest_snapshot(out_dir)
+    if name is None:
+        return None
+    return (read_artifact(os.path.join(out_dir, f'{name}-scores.feather')),
+            read_artifact(os.path.join(out_dir, f'{name}-contact.feather')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scores every patient in the churn window for the dashboard')
+    parser.add_argument('--data-dir', default='../data/raw', help='directory holding the raw exports')
+    parser.add_argument('--model', default='bestLRmodel.pkl', help='pickled model')
+    parser.add_argument('--out-dir', default='../data/scores', help='directory the snapshots are written to')
+    parser.add_argument('--cache-dir', default='../data/cache', help='directory of the Transform stage cache')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='rows scored per predict_proba call')
+    args = parser.parse_args(argv)
+
+    scores, contact, fingerprint = build(args.data_dir, args.model, args.cache_dir, args.chunk_size)
+    name = write_snapshot(scores, contact, fingerprint, args.out_dir)
+    print(f'wrote snapshot {name}: {len(scores)} scored patients, {len(contact)} contact patients')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from cache import CachedTransform, read_artifact, write_artifact
+from transform_data import ages
+
+# bump whenever the layout of the stored snapshot changes
+SNAPSHOT_VERSION = 1
+
+# absolute date columns kept by the snapshot, dropped from query results
+DATE_COLS = ['Birthdate', 'Last Visit']
+
+# average days per year, used to age patients with an unknown birthdate
+DAYS_PER_YEAR = 365.2425
+
+
+def _days(dates):
+    return dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype('int64')
+
+
+class PatientSnapshot:
+    """
+    Merged patient frame that keeps Last Visit and Birthdate as absolute dates, sorted by Last Visit, so churn and
+    contact windows as of any date are found by binary search instead of a pipeline rerun.
+
+    Recency and age are recomputed for the as of date of every query; age of patients without a birthdate is the
+    fill value of the build moved by the years between the build and the as of date.  Every other feature
+    (Frequency, Tenure, Total, provider features) reflects the history up to the build, so an as of date before the
+    build sees each patient's latest visit as of the build.  Point in time backtests need a snapshot built from the
+    exports as they were on that date.
+    """
+
+    def __init__(self, patients, built_at):
+        """
+        Parameters:
+            patients: merged patient frame with Birthdate and Last Visit (Transform(keep_dates=True).run), sorted by
+                      Last Visit with missing dates last
+            built_at: reference time the frame was built with
+        """
+        self.patients = patients
+        self.built_at = pd.Timestamp(built_at)
+        n_dated = int(patients['Last Visit'].notna().sum())
+        self.last_visit_days = _days(patients['Last Visit'].iloc[:n_dated])
+
+    @classmethod
+    def build(cls, data_dir, transform=None, now=None):
+        """
+        Runs the pipeline once and sorts its output by Last Visit
+
+        Parameters:
+            data_dir: directory holding the raw exports
+            transform: Transform with keep_dates=True, defaults to a CachedTransform
+            now: reference time of the build, defaults to midnight of the current day
+
+        Returns:
+            PatientSnapshot
+        """
+        transform = transform or CachedTransform(keep_dates=True)
+        if not transform.keep_dates:
+            raise ValueError('PatientSnapshot needs a Transform with keep_dates=True')
+        now = pd.Timestamp.now().normalize() if now is None else pd.Timestamp(now)
+        merged = transform.run(data_dir, now=now)
+        merged = merged.sort_values(['Last Visit', 'PatNum'], na_position='last', kind='mergesort')
+        return cls(merged.reset_index(drop=True), now)
+
+    def save(self, store_dir):
+        """
+        Writes the snapshot to store_dir
+
+        Parameters:
+            store_dir: directory holding patients.feather and snapshot.json
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        write_artifact(self.patients, os.path.join(store_dir, 'patients.feather'))
+        with open(os.path.join(store_dir, 'snapshot.json'), 'w') as file:
+            json.dump({'version': SNAPSHOT_VERSION, 'built_at': self.built_at.isoformat()}, file)
+
+    @classmethod
+    def load(cls, store_dir):
+        """
+        Loads a snapshot written by save, the patient frame is memory mapped
+
+        Parameters:
+            store_dir: directory holding patients.feather and snapshot.json
+
+        Returns:
+            PatientSnapshot, or None if there is no snapshot of the current version
+        """
+        meta_path = os.path.join(store_dir, 'snapshot.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as file:
+            meta = json.load(file)
+        if meta['version'] != SNAPSHOT_VERSION:
+            return None
+        return cls(read_artifact(os.path.join(store_dir, 'patients.feather')), meta['built_at'])
+
+    def positions(self, as_of, begin, end):
+        """
+        Parameters:
+            as_of: reference date
+            begin, end: window of days between the last visit and as_of, both inclusive
+
+        Returns:
+            Slice of the sorted patients whose Last Visit falls in the window
+        """
+        day = np.datetime64(pd.Timestamp(as_of).normalize(), 'D').astype('int64')
+        first = np.searchsorted(self.last_visit_days, day - end, side='left')
+        last = np.searchsorted(self.last_visit_days, day - begin, side='right')
+        return slice(first, max(first, last))
+
+    def window(self, as_of, begin, end):
+        """
+        Patients whose last visit falls between begin and end days before as_of, with Recency and age as of as_of
+
+        Parameters:
+            as_of: reference time
+            begin, end: window of days between the last visit and as_of, both inclusive
+
+        Returns:
+            df with the columns of the pipeline output, ordered by PatNum
+        """
+        as_of = pd.Timestamp(as_of)
+        df = self.patients.iloc[self.positions(as_of, begin, end)].copy()
+        df['Recency'] = (as_of - df['Last Visit']).dt.days.astype(self.patients['Recency'].dtype)
+
+        known = df['Birthdate'].notna()
+        shift = (as_of - self.built_at).days / DAYS_PER_YEAR
+        age = np.where(known, ages(df['Birthdate'], as_of), df['age'] + shift)
+        df['age'] = age.astype(self.patients['age'].dtype)
+        return df.drop(DATE_COLS, axis=1).sort_values('PatNum').reset_index(drop=True)
+
+    def data_split(self, as_of, churn_begin=150, churn_end=399, contact_begin=400, contact_end=720):
+        """
+        Equivalent of Transform.data_split as of any date, see Transform.data_split for the windows
+
+        Returns:
+            Two pandas dataframes for use with model predictions and prioritized contact list
+        """
+        return self.window(as_of, churn_begin, churn_end), self.window(as_of, contact_begin, contact_end)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Builds or queries the date indexed patient snapshot')
+    parser.add_argument('--store-dir', default='../data/snapshot', help='directory holding the snapshot')
+    parser.add_argument('--build', action='store_true', help='rebuild the snapshot from the raw exports')
+    parser.add_argument('--data-dir', default='../data/raw', help='directory holding the raw exports')
+    parser.add_argument('--cache-dir', default='../data/cache', help='directory of the Transform stage cache')
+    parser.add_argument('--as-of', help='report the churn and contact windows as of this date')
+    args = parser.parse_args(argv)
+
+    if args.build:
+        snapshot = PatientSnapshot.build(args.data_dir, CachedTransform(args.cache_dir, keep_dates=True))
+        snapshot.save(args.store_dir)
+        print(f'built snapshot of {len(snapshot.patients)} patients as of {snapshot.built_at.date()}')
+    else:
+        snapshot = PatientSnapshot.load(args.store_dir)
+        if snapshot is None:
+            parser.error(f'no snapshot in {args.store_dir}, run with --build first')
+    if args.as_of:
+        for_model, contact = snapshot.data_split(args.as_of)
+        print(f'as of {args.as_of}: {len(for_model)} patients in the churn window, {len(contact)} in the contact window')
+
+
+if __name__ == '__main__':
+    main()
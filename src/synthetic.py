@@ -0,0 +1,213 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from transform_data import RAW_FILES, BAD_PAY_DATE, NULL_DATE, NULL_DATETIME, FAKE_PATIENTS
+
+FIRST_NAMES = np.array(['mary', 'JAMES', 'Patricia', 'john', 'jennifer', 'Robert', 'LINDA', 'michael', 'Elizabeth',
+                        'william', 'barbara', 'David', 'susan', 'RICHARD', 'Jessica', 'joseph', 'sarah', 'Thomas'])
+PROVNUMS = np.array([1, 2, 3, 6, 7, 10, 15, 20])
+APT_STATUSES = np.array([1, 2, 3, 5, 6])
+APT_STATUS_PROBS = np.array([0.05, 0.8, 0.03, 0.08, 0.04])
+
+# appended unquoted to the malformed claims lines, as a free text note typed into the export
+BAD_LINE_NOTE = ',resubmitted, see note'
+
+
+def _date_strings(days, epoch):
+    return np.datetime_as_string(np.datetime64(epoch) + days.astype('timedelta64[D]'), unit='D')
+
+
+def make_patients(n_patients, end, years, rng):
+    """
+    Generates a patient table with the columns used by Transform.patient_transform
+
+    Parameters:
+        n_patients: number of patients
+        end: last day of practice history, np.datetime64
+        years: years of practice history
+        rng: numpy Generator
+
+    Returns:
+        Patient df and the first visit of each patient as days before end
+    """
+    first_visit = rng.integers(0, int(years * 365), n_patients)
+    birth = first_visit + rng.integers(365 * 2, 365 * 85, n_patients)
+    pat = pd.DataFrame({
+        'PatNum': np.arange(1, n_patients + 1),
+        'FName': rng.choice(FIRST_NAMES, n_patients),
+        'Birthdate': _date_strings(-birth, end),
+        'Gender': rng.choice([0, 1, 2], n_patients, p=[0.48, 0.5, 0.02]),
+        'EstBalance': np.round(rng.gamma(1, 60, n_patients) * (rng.random(n_patients) < 0.3), 2),
+        'InsEst': np.round(rng.gamma(1, 40, n_patients) * (rng.random(n_patients) < 0.4), 2),
+        'HasIns': np.where(rng.random(n_patients) < 0.65, 'I', ''),
+        'DateFirstVisit': _date_strings(-first_visit, end),
+    })
+
+    # unknown birthdates and inactive patients carry the null date sentinel
+    pat.loc[rng.random(n_patients) < 0.02, 'Birthdate'] = NULL_DATE
+    pat.loc[rng.random(n_patients) < 0.03, 'DateFirstVisit'] = NULL_DATE
+    return pat, first_visit
+
+
+def make_appointments(first_visit, end, visits_per_year, rng):
+    """
+    Generates an appointment table, including cancelled (AptStatus 5) and null dated appointments and a few
+    scheduled appointments after end
+
+    Parameters:
+        first_visit: first visit of each patient as days before end, PatNum is position + 1
+        end: last day of practice history, np.datetime64
+        visits_per_year: mean appointments per patient per year
+        rng: numpy Generator
+
+    Returns:
+        Appointment df
+    """
+    counts = rng.poisson(np.maximum(first_visit, 1) / 365 * visits_per_year) + 1
+    patnum = np.repeat(np.arange(1, len(first_visit) + 1), counts)
+    n_appts = len(patnum)
+
+    # days before end, spread between the first visit and a few weeks of future bookings
+    days = (rng.random(n_appts) * (np.repeat(first_visit, counts) + 30)).astype('int64') - 30
+    seconds = rng.integers(8, 17, n_appts) * 3600 + rng.choice([0, 1800], n_appts)
+    stamps = np.datetime64(end, 's') - days.astype('timedelta64[D]') + seconds.astype('timedelta64[s]')
+    dates = np.char.replace(np.datetime_as_string(stamps, unit='s'), 'T', ' ')
+
+    appt = pd.DataFrame({
+        'AptNum': np.arange(1, n_appts + 1),
+        'PatNum': patnum,
+        'AptStatus': rng.choice(APT_STATUSES, n_appts, p=APT_STATUS_PROBS),
+        'ProvNum': rng.choice(PROVNUMS, n_appts),
+        'AptDateTime': dates,
+    })
+    appt.loc[days < 0, 'AptStatus'] = 1
+    appt.loc[rng.random(n_appts) < 1e-5, 'AptDateTime'] = NULL_DATETIME
+    return appt.sort_values('AptDateTime', kind='mergesort').reset_index(drop=True)
+
+
+def make_payments(appt, has_ins, rng):
+    """
+    Generates payment and claims tables from the completed appointments
+
+    Parameters:
+        appt: appointment df from make_appointments
+        has_ins: boolean array, whether patient PatNum - 1 is insured
+        rng: numpy Generator
+
+    Returns:
+        Payment df and claims df
+    """
+    done = appt[(appt['AptStatus'] == 2) & (appt['AptDateTime'] != NULL_DATETIME)]
+    visit_day = pd.to_datetime(done['AptDateTime'].str[:10]).values.astype('datetime64[D]')
+
+    paid = rng.random(len(done)) < 0.7
+    pay_day = visit_day[paid] + rng.integers(0, 30, paid.sum()).astype('timedelta64[D]')
+    pay = pd.DataFrame({
+        'PayNum': np.arange(1, paid.sum() + 1),
+        'PayDate': np.datetime_as_string(pay_day, unit='D'),
+        'PatNum': done['PatNum'].values[paid],
+        'PayAmt': np.round(rng.gamma(2, 45, paid.sum()), 2),
+    })
+
+    # the erroneous batch posting
+    pay.loc[rng.random(len(pay)) < 0.002, 'PayDate'] = BAD_PAY_DATE
+
+    claimed = has_ins[done['PatNum'].values - 1]
+    claim_day = visit_day[claimed] + rng.integers(10, 60, claimed.sum()).astype('timedelta64[D]')
+    claims = pd.DataFrame({
+        'ClaimNum': np.arange(1, claimed.sum() + 1),
+        'PatNum': done['PatNum'].values[claimed],
+        'DateReceived': np.datetime_as_string(claim_day, unit='D'),
+        'InsPayAmt': np.round(rng.gamma(2, 70, claimed.sum()), 2),
+    })
+
+    # claims sent but never received
+    claims.loc[rng.random(len(claims)) < 0.1, 'DateReceived'] = NULL_DATE
+    return pay, claims
+
+
+def write_with_bad_lines(df, filepath, rate, rng):
+    """
+    Writes df as csv with malformed lines scattered through it, like the claims export: copies of rows with an
+    unquoted note appended, so they have too many fields
+
+    Parameters:
+        df: DataFrame to write
+        filepath: destination csv
+        rate: fraction of malformed lines
+        rng: numpy Generator
+
+    Returns:
+        Number of malformed lines written
+    """
+    n_bad = rng.binomial(len(df), rate) if len(df) else 0
+    cuts = np.sort(rng.choice(len(df), n_bad, replace=False)) if n_bad else np.array([], dtype='int64')
+    with open(filepath, 'w') as file:
+        df.iloc[:0].to_csv(file, index=False)
+        start = 0
+        for cut in cuts:
+            df.iloc[start:cut].to_csv(file, index=False, header=False)
+            file.write(df.iloc[[cut]].to_csv(index=False, header=False).rstrip('\n') + BAD_LINE_NOTE + '\n')
+            start = cut
+        df.iloc[start:].to_csv(file, index=False, header=False)
+    return n_bad
+
+
+def make_practice(data_dir, n_patients=10000, years=8, visits_per_year=2.0, bad_line_rate=1e-4, end=None, seed=0):
+    """
+    Writes synthetic payment, claims, appt and patient exports with the quirks of the real practice exports:
+    null date sentinels, cancelled appointments, fake patients, the bad pay date and malformed claims lines
+
+    Parameters:
+        data_dir: directory to write the exports to
+        n_patients: number of patients
+        years: years of practice history
+        visits_per_year: mean appointments per patient per year
+        bad_line_rate: fraction of malformed lines in the claims export
+        end: last day of practice history, defaults to today
+        seed: random seed
+
+    Returns:
+        Dict of table name to number of rows written, and the number of malformed claims lines under 'bad_lines'
+    """
+    rng = np.random.default_rng(seed)
+    end = np.datetime64(pd.Timestamp.now().normalize() if end is None else pd.Timestamp(end), 'D')
+    os.makedirs(data_dir, exist_ok=True)
+
+    pat, first_visit = make_patients(n_patients, end, years, rng)
+    appt = make_appointments(first_visit, end, visits_per_year, rng)
+    pay, claims = make_payments(appt, pat['HasIns'].values == 'I', rng)
+
+    # sprinkle test patients through the appointment book
+    fake = appt.sample(n=min(len(FAKE_PATIENTS) * 5, len(appt)), random_state=seed).index
+    appt.loc[fake, 'PatNum'] = np.resize(FAKE_PATIENTS, len(fake))
+
+    paths = {table: os.path.join(data_dir, filename) for table, filename in RAW_FILES.items()}
+    pat.to_csv(paths['patient'], index=False)
+    appt.to_csv(paths['appt'], index=False)
+    pay.to_csv(paths['payment'], index=False)
+    n_bad = write_with_bad_lines(claims, paths['claims'], bad_line_rate, rng)
+    return {'patient': len(pat), 'appt': len(appt), 'payment': len(pay), 'claims': len(claims), 'bad_lines': n_bad}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Writes synthetic practice exports for benchmarks and CI')
+    parser.add_argument('data_dir', help='directory to write the exports to')
+    parser.add_argument('--patients', type=int, default=10000, help='number of patients')
+    parser.add_argument('--years', type=float, default=8, help='years of practice history')
+    parser.add_argument('--visits-per-year', type=float, default=2.0, help='mean appointments per patient per year')
+    parser.add_argument('--end', help='last day of practice history, defaults to today')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args(argv)
+
+    counts = make_practice(args.data_dir, args.patients, args.years, args.visits_per_year, end=args.end,
+                           seed=args.seed)
+    n_bad = counts.pop('bad_lines')
+    print(', '.join(f'{rows} {table} rows' for table, rows in counts.items()), f'and {n_bad} malformed claims lines')
+
+
+if __name__ == '__main__':
+    main()
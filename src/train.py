@@ -0,0 +1,202 @@
+import argparse
+import itertools
+import os
+import pickle
+import time
+
+from joblib import Memory, Parallel, delayed
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import ParameterGrid, StratifiedKFold, train_test_split
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+import numpy as np
+import pandas as pd
+
+from cache import CachedTransform, file_digest
+from model_functions import threshold_table, best_threshold, save_threshold, save_training, export_logistic
+from score import model_features
+from transform_data import raw_paths
+
+# bump whenever the layout of the training metadata changes
+TRAIN_VERSION = 1
+
+# days without a visit after which a patient counts as churned
+CHURN_DAYS = 400
+
+# hyperparameter grids searched per model, the logistic regression is fitted on standardized features
+GRIDS = {
+    'logistic': {'model__penalty': ['l1', 'l2'], 'model__C': [0.01, 0.1, 1, 10]},
+    'forest': {'n_estimators': [100, 250, 500], 'max_depth': [8, 16, None], 'min_samples_split': [2, 4, 8],
+               'max_features': ['sqrt', 'log2']},
+}
+
+
+def make_estimator(name, random_state=0):
+    """
+    Parameters:
+        name: model name, see GRIDS
+        random_state: seed of the model
+
+    Returns:
+        Unfitted sklearn estimator
+    """
+    if name == 'logistic':
+        return Pipeline([('scale', StandardScaler()),
+                         ('model', LogisticRegression(solver='liblinear', max_iter=500, random_state=random_state))])
+    if name == 'forest':
+        # single threaded, the search runs the folds in parallel instead
+        return RandomForestClassifier(n_jobs=1, random_state=random_state)
+    raise ValueError(f'unknown model {name}, expected one of {list(GRIDS)}')
+
+
+def training_set(merged, churn_days=CHURN_DAYS, new_days=400, max_recency=2000):
+    """
+    Labels the pipeline output for training, as in the Logistic_Regression notebook.  Patients seen for the first
+    time within the last new_days and patients without a visit for max_recency days or more are left out.
+
+    Parameters:
+        merged: output of Transform.run
+        churn_days: patients with a Recency of at least churn_days are labelled as churned
+        new_days: Tenure and Recency below which a patient counts as new
+        max_recency: Recency from which patients are left out
+
+    Returns:
+        Features with the columns the dashboard scores (see score.model_features) and churn labels
+    """
+    new = (merged['Tenure'] < new_days) & (merged['Recency'] < churn_days)
+    df = merged[~new & (merged['Recency'] < max_recency)]
+    features = model_features(df).astype('float64').reset_index(drop=True)
+    labels = (df['Recency'] >= churn_days).astype('int64').reset_index(drop=True)
+    return features, labels
+
+
+def _fit_fold(estimator, params, X, y, train, test):
+    start = time.perf_counter()
+    model = clone(estimator).set_params(**params).fit(X[train], y[train])
+    fit_s = time.perf_counter() - start
+    return {'score': roc_auc_score(y[test], model.predict_proba(X[test])[:, 1]), 'fit_s': fit_s}
+
+
+def search(features, labels, models=tuple(GRIDS), folds=5, n_jobs=-1, memory=None, random_state=0):
+    """
+    Cross validated grid search of several models at once.  Every (model, parameters, fold) fit is an independent
+    task, so the fits of all models share the cores, and with a joblib Memory the score of every fold is stored
+    so reruns with overlapping grids only fit the new combinations.
+
+    Parameters:
+        features: df of model features
+        labels: churn labels aligned with features
+        models: model names, see GRIDS
+        folds: number of stratified folds
+        n_jobs: number of parallel fits, -1 for every core
+        memory: joblib Memory or cache directory for the fold scores, None to disable caching
+        random_state: seed of the folds and the models
+
+    Returns:
+        df of model, params and the mean and standard deviation of the fold ROC AUC per candidate, best first
+    """
+    X, y = features.to_numpy(dtype='float64'), np.asarray(labels)
+    if isinstance(memory, str):
+        memory = Memory(memory, verbose=0)
+    fit_fold = _fit_fold if memory is None else memory.cache(_fit_fold)
+    splits = list(StratifiedKFold(folds, shuffle=True, random_state=random_state).split(X, y))
+    candidates = [(name, params) for name in models for params in ParameterGrid(GRIDS[name])]
+    estimators = {name: make_estimator(name, random_state) for name in models}
+
+    tasks = list(itertools.product(range(len(candidates)), splits))
+    results = Parallel(n_jobs=n_jobs)(delayed(fit_fold)(estimators[candidates[i][0]], candidates[i][1], X, y,
+                                                        train, test) for i, (train, test) in tasks)
+    scores = pd.DataFrame({'candidate': [i for i, _ in tasks], 'score': [result['score'] for result in results],
+                           'fit_s': [result['fit_s'] for result in results]})
+    summary = scores.groupby('candidate').agg(score=('score', 'mean'), std=('score', 'std'), fit_s=('fit_s', 'sum'))
+    summary.insert(0, 'model', [candidates[i][0] for i in summary.index])
+    summary.insert(1, 'params', [candidates[i][1] for i in summary.index])
+    return summary.sort_values('score', ascending=False, kind='mergesort').reset_index(drop=True)
+
+
+def write_model(model, model_path, threshold, metadata, objective='f1'):
+    """
+    Pickles a model with its threshold and training metadata, and exports logistic regressions for
+    model_functions.LogisticScorer, so score.py and the dashboard load it like bestLRmodel.pkl
+
+    Parameters:
+        model: fitted model
+        model_path: destination of the pickled model, replaced atomically
+        threshold: churn threshold, see model_functions.save_threshold
+        metadata: training metadata, see model_functions.save_training
+        objective: description of how the threshold was chosen
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(model_path)), exist_ok=True)
+    tmp_path = f'{model_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(model, file)
+    os.replace(tmp_path, model_path)
+    save_threshold(model_path, threshold, objective)
+    save_training(model_path, {**metadata, 'model_digest': file_digest(model_path)})
+    if metadata['model'] == 'logistic':
+        export_logistic(model, model_path, metadata['features'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Trains the churn model on the cached Transform output')
+    parser.add_argument('--data-dir', default='../data/raw', help='directory holding the raw exports')
+    parser.add_argument('--cache-dir', default='../data/cache', help='directory of the Transform stage cache')
+    parser.add_argument('--fold-cache', default='../data/folds', help='directory of the fold score cache')
+    parser.add_argument('--out-dir', default='../models', help='directory the versioned models are written to')
+    parser.add_argument('--install', help='also install the model at this path, e.g. bestLRmodel.pkl for the app')
+    parser.add_argument('--models', nargs='+', choices=list(GRIDS), default=list(GRIDS), help='models to search')
+    parser.add_argument('--folds', type=int, default=5, help='number of cross validation folds')
+    parser.add_argument('--n-jobs', type=int, default=-1, help='parallel fits, -1 for every core')
+    parser.add_argument('--test-size', type=float, default=0.25, help='share of patients held out for the threshold')
+    parser.add_argument('--objective', default='f1', help='threshold_table column the threshold maximises')
+    parser.add_argument('--min-precision', type=float, help='lowest precision the threshold may have')
+    parser.add_argument('--min-recall', type=float, help='lowest recall the threshold may have')
+    parser.add_argument('--lifetime-features', action='store_true', help='train on the lifetime revenue features')
+    parser.add_argument('--now', help='reference time of the features, defaults to midnight of the current day')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the split, the folds and the models')
+    args = parser.parse_args(argv)
+
+    transform_options = {'lifetime_features': args.lifetime_features}
+    t = CachedTransform(args.cache_dir, **transform_options)
+    now = pd.Timestamp.now().normalize() if args.now is None else pd.Timestamp(args.now)
+    features, labels = training_set(t.run(args.data_dir, now=now))
+    xtrain, xtest, ytrain, ytest = train_test_split(features, labels, test_size=args.test_size, stratify=labels,
+                                                    random_state=args.seed)
+    print(f'{len(xtrain)} training and {len(xtest)} holdout patients, {labels.mean():.1%} churned')
+
+    results = search(xtrain, ytrain, args.models, args.folds, args.n_jobs, args.fold_cache, args.seed)
+    print(results.groupby('model').head(3).to_string(index=False))
+    best = results.iloc[0]
+    model = make_estimator(best['model'], args.seed).set_params(**best['params'])
+    if best['model'] == 'forest':
+        model.set_params(n_jobs=args.n_jobs)
+    model.fit(xtrain, ytrain)
+
+    probas = model.predict_proba(xtest)[:, 1]
+    table = threshold_table(ytest, probas)
+    threshold = best_threshold(table, args.objective, args.min_precision, args.min_recall)
+    chosen = table[table['threshold'] == threshold].iloc[0]
+
+    trained_at = pd.Timestamp.now()
+    metadata = {'version': TRAIN_VERSION, 'model': best['model'], 'params': best['params'],
+                'features': list(xtrain.columns), 'transform': transform_options,
+                'trained_at': trained_at.isoformat(), 'now': now.isoformat(),
+                'data': {table_name: t.cache.fingerprint(path)['sha1']
+                         for table_name, path in raw_paths(args.data_dir).items()},
+                'cv': {'folds': args.folds, 'roc_auc': float(best['score']), 'std': float(best['std'])},
+                'holdout': {'patients': len(xtest), 'roc_auc': float(roc_auc_score(ytest, probas)),
+                            'threshold': threshold, 'precision': float(chosen['precision']),
+                            'recall': float(chosen['recall']), 'f1': float(chosen['f1'])}}
+    name = f'churn-v{TRAIN_VERSION}-{trained_at:%Y%m%dT%H%M%S}-{best["model"]}.pkl'
+    paths = [os.path.join(args.out_dir, name)] + ([args.install] if args.install else [])
+    for path in paths:
+        write_model(model, path, threshold, metadata, args.objective)
+    print(f'{best["model"]} {best["params"]}: cv roc_auc {best["score"]:.3f}, holdout {metadata["holdout"]}')
+    print('wrote', *paths)
+
+
+if __name__ == '__main__':
+    main()
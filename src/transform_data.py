@@ -1,110 +1,629 @@
+import csv
+import io
+import os
+
 import pandas as pd
 import numpy as np
 
+from profiling import profiled
+from ranking import top_k
+
+# file names of the raw practice exports, keyed by table
+RAW_FILES = {'payment': 'payment.csv', 'claims': 'claims.csv', 'appt': 'appt.csv', 'patient': 'patient.csv'}
+
+
+def raw_paths(data_dir):
+    """
+    Builds the paths to the raw practice exports found in data_dir
+
+    Parameters:
+        data_dir: directory holding the payment, claims, appt and patient exports
+
+    Returns:
+        Dict of table name to filepath
+    """
+    return {table: os.path.join(data_dir, filename) for table, filename in RAW_FILES.items()}
+
+
+# formats of the date columns in the raw exports
+DATE_FORMAT = '%Y-%m-%d'
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_FORMATS = {'PayDate': DATE_FORMAT, 'DateReceived': DATE_FORMAT, 'AptDateTime': DATETIME_FORMAT,
+                'Birthdate': DATE_FORMAT, 'DateFirstVisit': DATE_FORMAT}
+
+# payment batch posted in error on this date, excluded from patient totals
+BAD_PAY_DATE = '2020-12-22'
+
+# sentinel used by the practice software for empty dates, as written in each date format
+NULL_DATE = '0001-01-01'
+NULL_DATETIME = f'{NULL_DATE} 00:00:00'
+NULL_DATES = {DATE_FORMAT: NULL_DATE, DATETIME_FORMAT: NULL_DATETIME}
+
+# test/fake patient records in the practice software
+FAKE_PATIENTS = [3645, 5686, 3391, 2, 5557, 2661]
+
+# hygienists used for the "seen by hygenist X" features
+PROVIDERS = [1, 2, 6, 7, 10, 15]
+
+# manual fixes to claims rows, keyed by row label of the claims export
+CLAIMS_CORRECTIONS = {17482: 754}
+
+PAY_COLS = ['PayDate', 'PatNum', 'PayAmt']
+CLAIMS_COLS = ['PatNum', 'DateReceived', 'InsPayAmt']
+APPT_COLS = ['PatNum', 'ProvNum', 'AptStatus', 'AptDateTime']
+PATIENT_COLS = ['FName', 'PatNum', 'Birthdate', 'Gender', 'EstBalance', 'InsEst', 'HasIns', 'DateFirstVisit']
+
+# columns combined into the contact list Score, see Transform.contact_transform
+CONTACT_FEATURES = ['Recency', 'Tenure', 'Total', 'Frequency']
+
+# revenue features added to the pay_transform output by Transform(lifetime_features=True), see Transform.pay_totals
+LIFETIME_FEATURES = ['PayAmt', 'InsPayAmt', 'n_pay', 'n_claims', 'PayTenure', 'PayRecency', 'Spend12m']
+
+# days before the reference time covered by Spend12m
+SPEND_WINDOW_DAYS = 365
+
+
+# dtypes the raw exports are read with by Transform(compact=True), date columns stay strings until date_transform
+READ_DTYPES = {
+    'payment': {'PatNum': 'int32', 'PayAmt': 'float32'},
+    'claims': {'PatNum': 'int32', 'InsPayAmt': 'float32'},
+    'appt': {'PatNum': 'int32', 'ProvNum': 'int16', 'AptStatus': 'uint8'},
+    'patient': {'PatNum': 'int32', 'FName': 'category', 'Gender': 'uint8', 'EstBalance': 'float32',
+                'InsEst': 'float32', 'HasIns': 'category'},
+}
+
+# dtypes of the transform outputs with Transform(compact=True), seen_by_X flags are also uint8 and DAY_COUNT_COLS
+# are downcast to the smallest integer type (float32 when a value is missing)
+FEATURE_DTYPES = {'HasIns': 'uint8', 'age': 'float32', 'Frequency': 'int32', 'Total': 'float32', 'PayAmt': 'float32',
+                  'InsPayAmt': 'float32', 'Spend12m': 'float32', 'n_pay': 'int32', 'n_claims': 'int32'}
+DAY_COUNT_COLS = ['Tenure', 'Recency', 'PayTenure', 'PayRecency']
+
+
+def frame_mb(df):
+    """
+    Memory used by a DataFrame including the contents of object columns, in MB
+    """
+    return df.memory_usage(deep=True).sum() / 2 ** 20
+
+
+def parse_dates(dates, format, sentinels=()):
+    """
+    Parses date strings of one known format in a single vectorized pass.  Values that are empty or malformed become
+    NaT, as do the sentinels.  Whether NULL_DATE is representable depends on the pandas version (it overflows
+    datetime64[ns] but not the datetime64[us] of pandas >= 2), so it has to be passed as a sentinel.
+
+    Parameters:
+        dates: Series of date strings
+        format: strftime format of the dates, e.g. DATE_FORMAT
+        sentinels: date strings to map to NaT, e.g. NULL_DATES[format]
+
+    Returns:
+        Series of datetime64
+    """
+    parsed = pd.to_datetime(dates, format=format, errors='coerce')
+    if len(sentinels):
+        parsed = parsed.mask(dates.isin(list(sentinels)))
+    return parsed
+
+
+@profiled()
+def provider_features(appt, providers=None, visit_counts=False, count_col=None):
+    """
+    Builds per patient provider features in a single pass over the appointments
+
+    Parameters:
+        appt: appointment rows with PatNum and ProvNum
+        providers: ProvNums to build features for, None to use every provider found in appt
+        visit_counts: also build visits_X columns with the number of appointments with provider X
+        count_col: column of appt holding the number of appointments per row, for rows that are already counted
+                   per patient and provider (default one appointment per row)
+
+    Returns:
+        df indexed by PatNum with binary seen_by_X columns (and visits_X columns) for every provider X
+    """
+    if providers is None:
+        providers = np.sort(appt['ProvNum'].dropna().astype('int64').unique()).tolist()
+    n_providers = len(providers)
+
+    # count appointments per (patient, provider) cell of a dense patient x provider matrix
+    pat_codes, patnums = pd.factorize(appt['PatNum'], sort=True)
+    prov_codes = pd.Index(providers).get_indexer(appt['ProvNum'])
+    keep = (pat_codes >= 0) & (prov_codes >= 0)
+    weights = None if count_col is None else appt[count_col].to_numpy(dtype='float64')[keep]
+    counts = np.bincount(pat_codes[keep] * n_providers + prov_codes[keep], weights=weights,
+                         minlength=len(patnums) * n_providers)
+    counts = counts.reshape(len(patnums), n_providers).astype('int64')
+
+    index = pd.Index(patnums, name='PatNum')
+    features = pd.DataFrame((counts > 0).astype('int64'), index=index, columns=[f'seen_by_{k}' for k in providers])
+    if visit_counts:
+        features[[f'visits_{k}' for k in providers]] = counts
+    return features
+
+
+@profiled()
+def pay_aggregates(pay=None, claims=None, now=None, dated=True):
+    """
+    Aggregates cleaned payment and claims rows per patient with a single groupby over the rows of both tables
+
+    Parameters:
+        pay: payment rows with PatNum, PayDate and PayAmt, None to aggregate claims only
+        claims: claims rows with PatNum, DateReceived and InsPayAmt, None to aggregate payments only
+        now: reference time of Spend12m, defaults to the current time
+        dated: also aggregate the payment dates, which have to be parsed first
+
+    Returns:
+        df indexed by PatNum of every patient with a payment or a claim, with summed PayAmt and InsPayAmt (0 for
+        patients missing from one of the tables) and the number of payments (n_pay) and claims (n_claims).  When
+        dated also the first and last payment or claim date (First Pay, Last Pay) and the PayAmt and InsPayAmt dated
+        within SPEND_WINDOW_DAYS up to now (Spend12m).
+    """
+    parts = []
+    if pay is not None:
+        part = {'PatNum': pay['PatNum'], 'PayAmt': pay['PayAmt'], 'InsPayAmt': 0.0, 'claim': 0}
+        parts.append(pd.DataFrame({**part, 'Date': pay['PayDate']} if dated else part))
+    if claims is not None:
+        part = {'PatNum': claims['PatNum'], 'PayAmt': 0.0, 'InsPayAmt': claims['InsPayAmt'], 'claim': 1}
+        parts.append(pd.DataFrame({**part, 'Date': claims['DateReceived']} if dated else part))
+    if not parts:
+        raise ValueError('pay_aggregates needs payment or claims rows')
+    rows = pd.concat(parts, ignore_index=True)
+    rows[['PayAmt', 'InsPayAmt']] = rows[['PayAmt', 'InsPayAmt']].astype('float64')
+
+    aggregations = {'PayAmt': ('PayAmt', 'sum'), 'InsPayAmt': ('InsPayAmt', 'sum'), 'rows': ('claim', 'size'),
+                    'n_claims': ('claim', 'sum')}
+    if dated:
+        rows['Date'] = parse_dates(rows['Date'], DATE_FORMAT, [NULL_DATE])
+        today = (pd.to_datetime('now') if now is None else pd.to_datetime(now)).normalize()
+        recent = (rows['Date'] > today - pd.Timedelta(days=SPEND_WINDOW_DAYS)) & (rows['Date'] <= today)
+        rows['Spend12m'] = (rows['PayAmt'] + rows['InsPayAmt']).where(recent, 0.0)
+        aggregations.update({'First Pay': ('Date', 'min'), 'Last Pay': ('Date', 'max'),
+                             'Spend12m': ('Spend12m', 'sum')})
+
+    grouped = rows.groupby('PatNum').agg(**aggregations)
+    grouped.insert(2, 'n_pay', grouped.pop('rows') - grouped['n_claims'])
+    return grouped
+
+
+def ages(birthdates, now):
+    """
+    Age in whole years at now, NaN for missing birthdates
+
+    Parameters:
+        birthdates: datetime64 Series
+        now: reference time
+
+    Returns:
+        Series of ages
+    """
+    # years of 365.2425 days, as numpy's timedelta64[Y] which pandas >= 2 no longer casts to
+    return np.floor((now - birthdates) / pd.Timedelta(days=365.2425))
+
+
+def line_fields(block, ends):
+    """
+    Counts the fields on every line of a block of csv lines without splitting it into lines
+
+    Parameters:
+        block: bytes of whole lines, each ending with a newline
+        ends: offsets of the newlines in block
+
+    Returns:
+        Array of the number of fields per line, 0 for blank lines
+    """
+    data = np.frombuffer(block, dtype='uint8')
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    if b'"' in block:
+        # quoted fields may hold delimiters, count them with the csv module
+        fields = np.array([len(row) for row in csv.reader(block.decode().split('\n')[:-1])], dtype='int64')
+    else:
+        # number of delimiters before every line end, differenced per line
+        fields = np.diff(np.searchsorted(np.flatnonzero(data == ord(',')), ends), prepend=0) + 1
+    lengths = ends - starts
+    fields[(lengths == 0) | ((lengths == 1) & (data[starts] == ord('\r')))] = 0
+    return fields
+
+
+def line_blocks(file, chunksize, block_size=1 << 22):
+    """
+    Reads a binary file in blocks of whole lines
+
+    Parameters:
+        file: binary file object
+        chunksize: number of lines per block, None for a single block
+        block_size: number of bytes read at a time
+
+    Returns:
+        Generator of bytes holding up to chunksize lines each (every line ends with a newline) and the offsets of
+        their newlines
+    """
+    rest = b''
+    while True:
+        data = file.read() if chunksize is None else file.read(block_size)
+        if not data:
+            if rest:
+                rest = rest if rest.endswith(b'\n') else rest + b'\n'
+                yield rest, np.flatnonzero(np.frombuffer(rest, dtype='uint8') == ord('\n'))
+            return
+        block = rest + data
+        ends = np.flatnonzero(np.frombuffer(block, dtype='uint8') == ord('\n'))
+        start, first = 0, 0
+        if chunksize is not None:
+            for last in range(chunksize - 1, len(ends), chunksize):
+                yield block[start:ends[last] + 1], ends[first:last + 1] - start
+                start, first = ends[last] + 1, last + 1
+        rest = block[start:]
+
+
+def read_csv_chunks(filepath, usecols, chunksize, bad_lines, dtype=None):
+    """
+    Reads a csv in fixed size chunks with the C parser, skipping malformed lines.  The field count of every line is
+    checked against the header before parsing, since the C parser does not flag lines with too many fields once
+    usecols is given (and in small chunks not even without it).  The count runs over the raw bytes of a chunk, and
+    only the malformed lines are cut out before the chunk is parsed.  Records may not span several lines.
+
+    Parameters:
+        filepath: path to the csv
+        usecols: columns to read
+        chunksize: number of lines per chunk, None to read the whole file as one chunk
+        bad_lines: list the 1-based line numbers of skipped malformed lines are appended to
+        dtype: optional dict of column dtypes
+
+    Returns:
+        Generator of DataFrame chunks, row labels are the positions of the lines among the data lines (counting the
+        malformed ones), which CLAIMS_CORRECTIONS is keyed by
+    """
+    with open(filepath, 'rb') as file:
+        columns = next(csv.reader([file.readline().decode('utf-8-sig')]))
+        line_number, row = 1, 0
+        for block, ends in line_blocks(file, chunksize):
+            fields = line_fields(block, ends)
+            data_lines = fields > 0
+            good = fields == len(columns)
+            bad = np.flatnonzero(data_lines & ~good)
+            labels = row + np.cumsum(data_lines)[good] - 1
+            bad_lines.extend((line_number + 1 + bad).tolist())
+            line_number += len(fields)
+            row += int(data_lines.sum())
+            if bad.size:
+                # keep the bytes between the malformed lines
+                starts = np.concatenate([[0], ends[bad] + 1])
+                stops = np.concatenate([np.where(bad > 0, ends[bad - 1] + 1, 0), [len(block)]])
+                block = b''.join(block[start:stop] for start, stop in zip(starts, stops))
+            if not labels.size:
+                continue
+            chunk = pd.read_csv(io.BytesIO(block), header=None, names=columns, usecols=usecols, engine='c',
+                                dtype=dtype)
+            chunk.index = labels
+            yield chunk
+
 
 class Transform:
-    def __init__(self):
-        pass
+    def __init__(self, providers=PROVIDERS, provider_visits=False, compact=True, track_memory=False,
+                 keep_dates=False, lifetime_features=False):
+        """
+        Parameters:
+            providers: ProvNums to build seen_by_X features for, None to use every provider in the appointment table
+            provider_visits: also build visits_X features with the number of appointments with each provider
+            compact: read the raw exports with READ_DTYPES and return outputs with FEATURE_DTYPES
+            track_memory: record the memory of every table read and stage output, see memory_report
+            keep_dates: keep the Birthdate and Last Visit columns in the patient output, see snapshot.PatientSnapshot
+            lifetime_features: add the LIFETIME_FEATURES revenue columns to the pay output, models trained without
+                               them have to be retrained
+        """
+        self.providers = providers
+        self.provider_visits = provider_visits
+        self.lifetime_features = lifetime_features
+        self.keep_dates = keep_dates
+        self.compact = compact
+        self.track_memory = track_memory
+        self.memory_log = []
+
+    def track(self, stage, frame, df):
+        """
+        Records the memory used by a frame of a stage when track_memory is set
+
+        Parameters:
+            stage: name of the stage
+            frame: name of the frame within the stage
+            df: the frame
+        """
+        if self.track_memory:
+            self.memory_log.append({'stage': stage, 'frame': frame, 'rows': len(df), 'mb': frame_mb(df)})
+
+    def memory_report(self):
+        """
+        Returns:
+            df of the memory recorded per stage and frame since the Transform was created
+        """
+        return pd.DataFrame(self.memory_log, columns=['stage', 'frame', 'rows', 'mb'])
+
+    def read_dtypes(self, table):
+        return READ_DTYPES[table] if self.compact else None
+
+    def compact_dtypes(self, df, stage):
+        """
+        Applies FEATURE_DTYPES to a stage output when compact is set
+
+        Parameters:
+            df: stage output
+            stage: name of the stage, for memory tracking
 
-    def pay_transform(self, pay_filepath, claims_filepath):
+        Returns:
+            df with compact dtypes
+        """
+        self.track(stage, 'output (default dtypes)', df)
+        if self.compact:
+            dtypes = {col: dtype for col, dtype in FEATURE_DTYPES.items() if col in df}
+            dtypes.update({col: 'uint8' for col in df if col.startswith('seen_by_')})
+            df = df.astype(dtypes)
+            for col in DAY_COUNT_COLS:
+                if col in df:
+                    complete = df[col].notna().all()
+                    df[col] = pd.to_numeric(df[col], downcast='integer') if complete else df[col].astype('float32')
+        self.track(stage, 'output', df)
+        return df
+
+    @profiled()
+    def pay_transform(self, pay_filepath, claims_filepath, now=None):
         """
         Transforms raw data into grouped values of all patient payments made, both out of pocket and insurance
 
         Parameters:
              pay_filepath: path to payment table
              claims_filepath: path to claims table
+             now: reference time of the lifetime features, defaults to the current time
         Returns:
-            Merged table with Total of all patient payments over course of entire patient life
+            Table indexed by PatNum with Total of all patient payments over course of entire patient life
+        """
+        now = pd.to_datetime('now') if now is None else pd.to_datetime(now)
+
+        # clean pay and claims tables
+        pay = self.clean_payments(self.read_payments(pay_filepath))
+        claims = self.clean_claims(self.read_claims(claims_filepath))
+
+        # one groupby over the rows of both tables, patients found in only one of them are kept
+        grouped = pay_aggregates(pay, claims, now=now, dated=self.lifetime_features)
+        return self.pay_totals(grouped, now=now)
+
+    @profiled()
+    def read_payments(self, pay_filepath):
+        pay = pd.read_csv(pay_filepath, usecols=PAY_COLS, dtype=self.read_dtypes('payment'))
+        self.track('read', 'payment', pay)
+        return pay
+
+    @profiled()
+    def read_claims(self, claims_filepath):
+        # the claims export has malformed lines, which pandas parses as rows once usecols is given
+        chunks = list(read_csv_chunks(claims_filepath, CLAIMS_COLS, None, [], self.read_dtypes('claims')))
+        claims = chunks[0] if chunks else pd.read_csv(claims_filepath, usecols=CLAIMS_COLS, nrows=0,
+                                                      dtype=self.read_dtypes('claims'))
+        self.track('read', 'claims', claims)
+        return claims
+
+    @profiled()
+    def read_appts(self, appt_filepath):
+        appt = pd.read_csv(appt_filepath, usecols=APPT_COLS, dtype=self.read_dtypes('appt'))
+        self.track('read', 'appt', appt)
+        return appt
+
+    @profiled()
+    def read_patients(self, pat_filepath):
+        # usecols keeps the file's column order, select in PATIENT_COLS order as the database query does
+        pat = pd.read_csv(pat_filepath, usecols=PATIENT_COLS, dtype=self.read_dtypes('patient'))[PATIENT_COLS]
+        self.track('read', 'patient', pat)
+        return pat
+
+    @profiled()
+    def clean_payments(self, pay):
         """
+        Drops payments posted on BAD_PAY_DATE
 
-        # clean and transform pay table
-        pay = pd.read_csv(pay_filepath, usecols=['PayDate', 'PatNum', 'PayAmt'])
-        pay = pay[pay['PayDate'] != '2020-12-22']
-        grouped_pay = pay.groupby("PatNum", as_index=False)['PayAmt'].sum()
+        Parameters:
+            pay: raw payment rows with PayDate, PatNum and PayAmt
 
-        # clean and transform claims table
-        claims = pd.read_csv(claims_filepath, engine='python', error_bad_lines=False,
-                             usecols=['PatNum', 'DateReceived', 'InsPayAmt'])
-        claims = claims[claims['DateReceived'] != '0001-01-01']
-        claims.loc[17482, 'InsPayAmt'] = 754
-        claims.drop('DateReceived', axis=1, inplace=True)
-        grouped_claims = claims.groupby('PatNum', as_index=False).sum()
+        Returns:
+            Filtered payment rows
+        """
+        return pay[pay['PayDate'] != BAD_PAY_DATE]
 
-        # merge tables and create "TOTAL" for further use
-        merged = grouped_claims.merge(grouped_pay)
-        merged['Total'] = merged['InsPayAmt'] + merged['PayAmt']
-        merged = merged.loc[:, ['PatNum', 'Total']]
+    @profiled()
+    def clean_claims(self, claims):
+        """
+        Drops claims that were never received and applies CLAIMS_CORRECTIONS
 
-        #merged.to_csv('../data/model/total.csv', index=False)
-        return merged
+        Parameters:
+            claims: raw claims rows with PatNum, DateReceived and InsPayAmt, indexed by row of the claims export
 
-    def patient_transform(self, appt_filepath, pat_filepath):
+        Returns:
+            Received claims rows
+        """
+        claims = claims[claims['DateReceived'] != NULL_DATE]
+        for row, amount in CLAIMS_CORRECTIONS.items():
+            if row in claims.index:
+                claims.loc[row, 'InsPayAmt'] = amount
+        return claims
+
+    @profiled()
+    def pay_totals(self, grouped, now=None):
+        """
+        Builds lifetime totals from per patient payment aggregates
+
+        Parameters:
+            grouped: df indexed by PatNum with summed PayAmt and InsPayAmt, and with lifetime_features set also
+                     n_pay, n_claims, First Pay, Last Pay and Spend12m, see pay_aggregates
+            now: reference time for PayTenure and PayRecency, defaults to the current time
+
+        Returns:
+            df indexed by PatNum with Total (and LIFETIME_FEATURES), for every patient with a payment or a claim
+        """
+        amounts = grouped[['PayAmt', 'InsPayAmt']].fillna(0)
+        total = pd.DataFrame({'Total': amounts['InsPayAmt'] + amounts['PayAmt']})
+        if self.lifetime_features:
+            now = pd.to_datetime('now') if now is None else pd.to_datetime(now)
+            for col in ['PayAmt', 'InsPayAmt']:
+                total[col] = amounts[col]
+            for col in ['n_pay', 'n_claims']:
+                total[col] = grouped[col]
+            total['PayTenure'] = (now - grouped['First Pay']).dt.days
+            total['PayRecency'] = (now - grouped['Last Pay']).dt.days
+            total['Spend12m'] = grouped['Spend12m']
+        total.index.name = 'PatNum'
+        return self.compact_dtypes(total, 'pay_transform')
+
+    @profiled()
+    def patient_transform(self, appt_filepath, pat_filepath, now=None):
         """
         Transforms raw data into patient df for use in predictive modeling
 
         Parameters:
              appt_filepath: filepath to appointment table
              pat_filepath: filepath to patient table
+             now: reference time for age and Recency, defaults to the current time
 
         Returns:
             Merged DataFrame of appt and patient tables for use with model for predictions and contact list
         """
 
-        patient_cols = ['FName', 'PatNum', 'Birthdate', 'Gender', 'EstBalance', 'InsEst', 'HasIns', 'DateFirstVisit']
-        appt = pd.read_csv(appt_filepath, usecols=['PatNum', 'ProvNum', 'AptStatus', 'AptDateTime'])
-        pat = pd.read_csv(pat_filepath, usecols=patient_cols)
+        appt = self.clean_appts(self.read_appts(appt_filepath))
+        pat = self.read_patients(pat_filepath)
+
+        # create binary "seen by hygenist X" columns
+        providers = provider_features(appt, self.providers, self.provider_visits)
+
+        #create new Frequency and Last Visit columns
+        visits = appt.groupby('PatNum')['AptDateTime'].agg(['count', 'max'])
+        visits.columns = ['Frequency', 'Last Visit']
+
+        return self.patient_features(pat, visits, providers, now=now)
+
+    @profiled()
+    def clean_appts(self, appt):
+        """
+        Drops cancelled appointments, bad dates and fake patients, and parses appointment dates
+
+        Parameters:
+            appt: raw appointment rows with PatNum, ProvNum, AptStatus and AptDateTime
+
+        Returns:
+            Appointment rows with PatNum, ProvNum and AptDateTime as a date
+        """
 
         #drop cancelled appointments
         appt = appt[appt['AptStatus'] != 5]
-        appt.drop('AptStatus', axis=1, inplace=True)
-
-        #drop bad date entries (only 2)
-        appt = appt[appt['AptDateTime'] != '0001-01-01 00:00:00']
+        appt = appt.drop('AptStatus', axis=1)
 
         #drop fake patients
-        appt = appt[~appt['PatNum'].isin([3645, 5686, 3391, 2, 5557, 2661])]
+        appt = appt[~appt['PatNum'].isin(FAKE_PATIENTS)]
+
+        #drop bad date entries (only 2), empty dates are kept as NaT
+        missing = appt['AptDateTime'].isna()
+        appt = self.date_transform(appt, ['AptDateTime'])
+        appt = appt[appt['AptDateTime'].notna() | missing]
 
         #remove time from date/time column
-        appt['AptDateTime'] = appt['AptDateTime'].str[:10]
-        appt['AptDateTime'] = pd.to_datetime(appt['AptDateTime'])
+        appt['AptDateTime'] = appt['AptDateTime'].dt.normalize()
+        return appt
+
+    @profiled()
+    def date_transform(self, df, columns):
+        """
+        Date normalization stage, parses raw date columns with their known DATE_FORMATS
+
+        Parameters:
+            df: raw table
+            columns: date columns to parse
+
+        Returns:
+            df with the columns as datetime64, NULL_DATE sentinels and empty values are NaT
+        """
+        for col in columns:
+            df[col] = parse_dates(df[col], DATE_FORMATS[col], [NULL_DATES[DATE_FORMATS[col]]])
+        return df
+
+    @profiled()
+    def patient_features(self, pat, visits, providers, now=None):
+        """
+        Builds the model/contact features from the patient table and per patient appointment aggregates
+
+        Parameters:
+            pat: raw patient table
+            visits: df indexed by PatNum with appointment count (Frequency) and latest appointment date (Last Visit)
+            providers: df indexed by PatNum of provider features, see provider_features
+            now: reference time for age and Recency, defaults to the current time
+
+        Returns:
+            Merged DataFrame of appt and patient tables for use with model for predictions and contact list
+        """
 
         # remove incorrect birthdates and transform date columns
-        pat['Birthdate'] = np.where(pat['Birthdate'] == '0001-01-01', np.nan, pat['Birthdate'])
-        pat['Birthdate'] = pd.to_datetime(pat['Birthdate'])
+        pat = self.date_transform(pat, ['Birthdate'])
 
         # create age column and fill nan's with mean age
-        now = pd.to_datetime('now')
-        pat['age'] = (now - pat['Birthdate']).astype('<m8[Y]')
-        pat.age.fillna(pat.age.mean(), inplace=True)
-        pat.drop('Birthdate', axis=1, inplace=True)
+        now = pd.to_datetime('now') if now is None else pd.to_datetime(now)
+        pat['age'] = ages(pat['Birthdate'], now)
+        pat['age'] = pat['age'].fillna(pat['age'].mean())
+        if not self.keep_dates:
+            pat.drop('Birthdate', axis=1, inplace=True)
 
         # drop inactive patients and transform HasIns col
-        pat = pat[pat['DateFirstVisit'] != '0001-01-01']
-        pat['DateFirstVisit'] = pd.to_datetime(pat['DateFirstVisit'])
+        pat = pat[pat['DateFirstVisit'] != NULL_DATE]
+        pat = self.date_transform(pat, ['DateFirstVisit'])
         pat['HasIns'] = np.where(pat['HasIns'] == 'I', 1, 0)
 
-        # create Provider dictionary to create binary "seen by hygenist X" columns
-        provider_dict = {k: (appt[appt['ProvNum'] == k]['PatNum']).unique() for k in [1, 2, 6, 7, 10, 15]}
+        providers = providers.reindex(pat['PatNum'], fill_value=0)
+        for col in providers.columns:
+            pat[col] = providers[col].values
 
-        pat['seen_by_1'] = np.where(pat['PatNum'].isin(provider_dict[1]), 1, 0)
-        pat['seen_by_2'] = np.where(pat['PatNum'].isin(provider_dict[2]), 1, 0)
-        pat['seen_by_6'] = np.where(pat['PatNum'].isin(provider_dict[6]), 1, 0)
-        pat['seen_by_7'] = np.where(pat['PatNum'].isin(provider_dict[7]), 1, 0)
-        pat['seen_by_10'] = np.where(pat['PatNum'].isin(provider_dict[10]), 1, 0)
-        pat['seen_by_15'] = np.where(pat['PatNum'].isin(provider_dict[15]), 1, 0)
-
-        #create new Frequency, Last Visit, Tenure and Recency columns
-        grouped = appt.groupby('PatNum')['AptDateTime'].agg(['count', 'max']).reset_index()
-        grouped.columns = ['PatNum', 'Frequency', 'Last Visit']
-        merged = pat.merge(grouped)
-        merged['Tenure'] = merged['Tenure'] = (merged['Last Visit'] - merged['DateFirstVisit']).dt.days
-        merged['Recency'] = (pd.to_datetime('now') - merged['Last Visit']).dt.days
+        #create new Tenure and Recency columns
+        merged = pat.merge(visits.rename_axis('PatNum').reset_index())
+        merged['Tenure'] = (merged['Last Visit'] - merged['DateFirstVisit']).dt.days
+        merged['Recency'] = (now - merged['Last Visit']).dt.days
 
         #drop all time based columns
-        merged.drop(['DateFirstVisit', 'Last Visit'], axis=1, inplace=True)
+        time_cols = ['DateFirstVisit'] if self.keep_dates else ['DateFirstVisit', 'Last Visit']
+        merged.drop(time_cols, axis=1, inplace=True)
+
+        return self.compact_dtypes(merged, 'patient_transform')
+
+    @profiled()
+    def merge_transform(self, patient, total):
+        """
+        Joins payment totals onto the patient frame by position lookups into the PatNum index of the totals
+
+        Parameters:
+            patient: output of patient_transform
+            total: output of pay_transform
 
+        Returns:
+            Merged DataFrame of patients that have payment history, in the order of patient
+        """
+        positions = total.index.get_indexer(patient['PatNum'])
+        found = positions >= 0
+        merged = patient[found].reset_index(drop=True)
+        for col in total.columns:
+            merged[col] = total[col].to_numpy()[positions[found]]
+        self.track('merge_transform', 'output', merged)
         return merged
 
+    @profiled()
+    def run(self, data_dir, now=None):
+        """
+        Runs pay_transform and patient_transform on the raw exports in data_dir and merges the results
+
+        Parameters:
+            data_dir: directory holding the payment, claims, appt and patient exports
+            now: reference time for age, Recency and the lifetime features, defaults to the current time
+
+        Returns:
+            Merged DataFrame ready for data_split
+        """
+        paths = raw_paths(data_dir)
+        total = self.pay_transform(paths['payment'], paths['claims'], now=now)
+        patient = self.patient_transform(paths['appt'], paths['patient'], now=now)
+        return self.merge_transform(patient, total)
+
+    @profiled()
     def data_split(self, dataframe, churn_begin=150, churn_end=399, contact_begin=400, contact_end=720):
         """
         Splits dataframe into two sets, one for making churn predictions and one for creating prioritized contact list
@@ -124,25 +643,71 @@ class Transform:
 
         return for_model, contact_list
 
-    def contact_transform(self, df, tenure_term=50, total_term=50, frequency_term=10):
+    @profiled()
+    def contact_transform(self, df, tenure_term=50, total_term=50, frequency_term=10, num_patients=None):
         """
         Creates specific df for use as a prioiritzed contact list for dental staff.  Score is calculated as follows:
         Final Score = Recency (days) - Tenure/50 (days) - Total/50 ($) - Frequency/10 (visits)
-        The lower the score, the higher the priority on the contact list.
+        The lower the score, the higher the priority on the contact list.  To rescore the same patients with
+        different terms build a ContactIndex once and call its top method instead.
 
         Parameters:
             df: contact_list df from previous step in chain
             tenure_term: term to shrink tenure value, higher term gives less weight to this value, default = 50
             total_term: term to shrink total value, higher term gives less weight to this value, default = 50
             frequency_term: term to shrink frequency value, higher term gives less weight to this value, default = 10
+            num_patients: number of patients to return, default returns every patient
 
         Returns:
-            Pandas df of patients sorted in prioritzed order for recontact based on calculated score
+            Pandas df of patients sorted in prioritzed order for recontact based on calculated score, ties are
+            ordered by PatNum
         """
-        df = df.loc[:, ['PatNum', 'FName', 'Recency', 'Tenure', 'Total', 'Frequency']]
-        df['Score'] = df['Recency'] - df['Tenure']/tenure_term - df['Total']/total_term - df['Frequency']/frequency_term
+        return ContactIndex(df).top(num_patients, tenure_term, total_term, frequency_term)
+
+
+class ContactIndex:
+    """
+    Numeric contact list built once per data load for rescoring with different terms, see
+    Transform.contact_transform.  Rescoring is one matrix-vector product of the CONTACT_FEATURES with the weights
+    (1, -1/tenure_term, -1/total_term, -1/frequency_term) and a top_k selection; only the returned rows are formatted
+    for display.
+    """
+
+    def __init__(self, df):
+        """
+        Parameters:
+            df: contact_list df from Transform.data_split
+        """
+        self.patients = df.loc[:, ['PatNum', 'FName'] + CONTACT_FEATURES].reset_index(drop=True)
+        self.features = self.patients[CONTACT_FEATURES].to_numpy(dtype='float64')
+        self.patnums = self.patients['PatNum'].to_numpy()
+
+    def __len__(self):
+        return len(self.patients)
+
+    def scores(self, tenure_term=50, total_term=50, frequency_term=10):
+        """
+        Returns:
+            Array of the contact Score of every patient, aligned with self.patients
+        """
+        return self.features @ np.array([1, -1 / tenure_term, -1 / total_term, -1 / frequency_term])
+
+    def top(self, num_patients=None, tenure_term=50, total_term=50, frequency_term=10):
+        """
+        Parameters:
+            num_patients: number of patients to return, default returns every patient
+            tenure_term, total_term, frequency_term: see Transform.contact_transform
+
+        Returns:
+            Display df of the num_patients lowest scores, as Transform.contact_transform
+        """
+        scores = self.scores(tenure_term, total_term, frequency_term)
+        rows = top_k(scores, num_patients, self.patnums, largest=False)
+        df = self.patients.iloc[rows].copy()
+        df['Score'] = scores[rows]
+
+        # only the selected rows are formatted for display
         df['FName'] = df['FName'].str[0].str.upper() + df['FName'].str[1:].str.lower()
         df.rename(columns={'FName':'First Name'}, inplace=True)
         df['Total'] = round(df['Total']).apply(lambda x : "${:,}".format(x))
-        df = df.sort_values('Score')
         return df
@@ -0,0 +1,29 @@
+import os
+
+import pandas as pd
+
+from cache import StageCache
+
+
+def test_stage_cache_keeps_recent_outputs(tmp_path):
+    cache = StageCache(str(tmp_path), keep=2)
+    builds = []
+
+    def get(stage, day):
+        def build():
+            builds.append((stage, day))
+            return pd.DataFrame({'day': [day]})
+        return cache.get_or_build(stage, build, params={'now': day})
+
+    for day in ['2021-06-28', '2021-06-29', '2021-06-30']:
+        assert get('patient', day)['day'].tolist() == [day]
+    get('pay', '2021-06-30')
+    stored = sorted(filename for filename in os.listdir(str(tmp_path)) if filename.endswith('.feather'))
+    assert [filename.split('-')[0] for filename in stored].count('patient') == 2
+    assert [filename.split('-')[0] for filename in stored].count('pay') == 1
+
+    # the oldest output was removed and is rebuilt, the newest is still served from the cache
+    get('patient', '2021-06-30')
+    get('patient', '2021-06-28')
+    assert builds.count(('patient', '2021-06-30')) == 1
+    assert builds.count(('patient', '2021-06-28')) == 2
@@ -0,0 +1,35 @@
+import pandas as pd
+import pytest
+
+from db_source import DBTransform, load_sqlite, sqlite_source
+from synthetic import make_practice
+from transform_data import Transform, CLAIMS_CORRECTIONS
+
+END = '2021-06-30'
+
+
+@pytest.fixture(scope='module')
+def data_dir(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('raw'))
+    make_practice(data_dir, n_patients=3000, end=END, seed=3)
+    return data_dir
+
+
+@pytest.fixture(scope='module')
+def source(data_dir, tmp_path_factory):
+    db_path = str(tmp_path_factory.mktemp('db') / 'practice.db')
+    load_sqlite(data_dir, db_path)
+    source = sqlite_source(db_path)
+    yield source
+    source.pool.close()
+
+
+@pytest.mark.parametrize('options', [{'compact': False}, {'compact': True}, {'lifetime_features': True},
+                                     {'compact': True, 'lifetime_features': True}])
+def test_sqlite_source_matches_csv(data_dir, source, options):
+    now = pd.Timestamp(END)
+    # called like a Transform, the data_dir is ignored
+    db = DBTransform(source, claim_corrections=CLAIMS_CORRECTIONS, **options).run(data_dir, now=now)
+    csv = Transform(**options).run(data_dir, now=now)
+    pd.testing.assert_frame_equal(db.sort_values('PatNum').reset_index(drop=True),
+                                  csv.sort_values('PatNum').reset_index(drop=True))
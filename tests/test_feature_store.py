@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+
+from feature_store import PatientFeatureStore
+from synthetic import make_practice
+from transform_data import Transform, raw_paths
+
+END = '2021-06-30'
+
+
+def assert_matches_rebuild(store, data_dir, now):
+    paths = raw_paths(data_dir)
+    pd.testing.assert_frame_equal(store.pay_transform(),
+                                  store.transform.pay_transform(paths['payment'], paths['claims']))
+    pd.testing.assert_frame_equal(store.patient_transform(paths['patient'], now=now),
+                                  store.transform.patient_transform(paths['appt'], paths['patient'], now=now))
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_incremental_updates_match_full_rebuild(tmp_path, compact):
+    data_dir, store_dir = str(tmp_path / 'raw'), str(tmp_path / 'features')
+    make_practice(data_dir, n_patients=2000, end=END, seed=1)
+    store = PatientFeatureStore(store_dir, Transform(compact=compact))
+    now = pd.Timestamp(END)
+
+    assert store.update(data_dir, cutoff='2021-03-31') == pd.Timestamp('2021-03-31')
+    assert_matches_rebuild(store, data_dir, now)
+
+    assert store.update(data_dir, cutoff='2021-06-29') == pd.Timestamp('2021-06-29')
+    assert store.watermark == pd.Timestamp('2021-06-29')
+    assert_matches_rebuild(store, data_dir, now)
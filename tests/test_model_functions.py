@@ -0,0 +1,67 @@
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from model_functions import threshold_table, best_threshold, export_logistic, load_logistic
+
+
+def _threshold_loop(ytest, probas, thresholds):
+    rows = []
+    for thresh in thresholds:
+        predicted = probas >= thresh
+        tp, fp = int((predicted & ytest).sum()), int((predicted & ~ytest).sum())
+        fn, tn = int((~predicted & ytest).sum()), int((~predicted & ~ytest).sum())
+        rows.append({'threshold': thresh, 'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn,
+                     'precision': tp / (tp + fp) if tp + fp else 0.0, 'recall': tp / (tp + fn),
+                     'f1': 2 * tp / (2 * tp + fp + fn) if tp else 0.0})
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize('thresholds', [None, np.linspace(0, 1, 21)])
+def test_threshold_table_matches_loop(thresholds):
+    rng = np.random.default_rng(0)
+    # rounded so many patients share a probability, including the candidate thresholds themselves
+    probas = np.round(rng.random(2000), 2)
+    ytest = rng.random(2000) < probas
+    table = threshold_table(ytest, probas, thresholds)
+    expected = _threshold_loop(ytest, probas, np.unique(probas) if thresholds is None else thresholds)
+    pd.testing.assert_frame_equal(table, expected, check_dtype=False)
+
+
+def test_best_threshold():
+    table = pd.DataFrame({'threshold': [0.3, 0.4, 0.5, 0.6], 'precision': [0.5, 0.6, 0.7, 0.9],
+                          'recall': [0.9, 0.8, 0.8, 0.4], 'f1': [0.6, 0.7, 0.7, 0.5]})
+    assert best_threshold(table) == 0.5
+    assert best_threshold(table, min_precision=0.8) == 0.6
+    with pytest.raises(ValueError):
+        best_threshold(table, min_precision=0.95)
+
+
+def test_logistic_scorer_matches_sklearn(tmp_path):
+    pytest.importorskip('sklearn')
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    rng = np.random.default_rng(0)
+    features = pd.DataFrame(rng.normal(size=(2000, 5)) * [1, 10, 100, 1000, 0.1],
+                            columns=[f'feature_{i}' for i in range(5)])
+    churn = features.to_numpy() @ rng.normal(size=5) / 100 + rng.normal(size=2000) > 0
+    model = make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000)).fit(features, churn)
+    model_path = str(tmp_path / 'model.pkl')
+    with open(model_path, 'wb') as file:
+        pickle.dump(model, file)
+    export_logistic(model, model_path)
+
+    scorer = load_logistic(model_path)
+    np.testing.assert_allclose(scorer.predict_proba(features), model.predict_proba(features), atol=1e-9)
+    with pytest.raises(ValueError):
+        scorer.predict_proba(features[features.columns[::-1]])
+
+    # the artifact is ignored once the pickled model changes
+    with open(model_path, 'ab') as file:
+        file.write(b'\0')
+    assert os.path.exists(model_path) and load_logistic(model_path) is None
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+
+from ranking import top_k
+
+
+def test_top_k_breaks_ties_by_id():
+    values = np.array([0.5, 0.9, 0.5, 0.5, 0.1])
+    ids = np.array([40, 10, 30, 20, 50])
+    np.testing.assert_array_equal(top_k(values, 3, ids), [1, 3, 2])
+    np.testing.assert_array_equal(top_k(values, 3, ids, largest=False), [4, 3, 2])
+
+
+def test_top_k_ignores_row_order():
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 5, 1000).astype('float64')
+    ids = rng.permutation(1000) + 1
+    order = rng.permutation(1000)
+    selected = ids[top_k(values, 50, ids)]
+    np.testing.assert_array_equal(ids[order][top_k(values[order], 50, ids[order])], selected)
+
+
+def test_top_k_ranks_nan_last():
+    values = np.array([np.nan, 0.2, np.nan, 0.8, 0.5])
+    ids = np.array([1, 2, 3, 4, 5])
+    np.testing.assert_array_equal(top_k(values, None, ids), [3, 4, 1, 0, 2])
+    np.testing.assert_array_equal(top_k(values, None, ids, largest=False), [1, 4, 3, 0, 2])
+    np.testing.assert_array_equal(top_k(values, 2, ids, largest=False), [1, 4])
+
+
+def test_top_k_bounds():
+    values, ids = np.array([0.3, 0.1, 0.2]), np.array([1, 2, 3])
+    assert len(top_k(values, 0, ids)) == 0
+    np.testing.assert_array_equal(top_k(values, 10, ids), [0, 2, 1])
+
+
+def test_top_k_matches_full_sort():
+    rng = np.random.default_rng(1)
+    scores = np.round(rng.normal(size=10000), 2)
+    patnums = rng.permutation(10000) + 1
+    expected = pd.DataFrame({'score': scores, 'PatNum': patnums}).sort_values(['score', 'PatNum']).index[:50]
+    np.testing.assert_array_equal(top_k(scores, 50, patnums, largest=False), expected)
@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+
+from snapshot import PatientSnapshot
+from synthetic import make_practice
+from transform_data import Transform
+
+END = '2021-06-30'
+
+
+@pytest.fixture(scope='module')
+def data_dir(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('raw'))
+    make_practice(data_dir, n_patients=3000, end=END, seed=5)
+    return data_dir
+
+
+@pytest.fixture(scope='module')
+def snapshot(data_dir):
+    return PatientSnapshot.build(data_dir, Transform(keep_dates=True), now=END)
+
+
+def test_snapshot_windows_match_data_split(data_dir, snapshot):
+    t = Transform()
+    merged = t.run(data_dir, now=pd.Timestamp(END))
+    for expected, window in zip(t.data_split(merged), snapshot.data_split(END)):
+        assert len(window)
+        pd.testing.assert_frame_equal(window, expected.sort_values('PatNum').reset_index(drop=True))
+
+
+def test_snapshot_window_as_of_earlier_date(snapshot):
+    as_of = pd.Timestamp(END) - pd.Timedelta(days=90)
+    window = snapshot.window(as_of, 150, 399)
+    assert window['Recency'].between(150, 399).all()
+    shifted = snapshot.window(END, 240, 489)
+    assert window['PatNum'].tolist() == shifted['PatNum'].tolist()
+    assert (shifted['Recency'] - window['Recency'] == 90).all()
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cache import CachedTransform
+from score import model_features, predict_in_chunks
+from synthetic import make_practice
+from transform_data import (Transform, ContactIndex, pay_aggregates, raw_paths, parse_dates, DATETIME_FORMAT,
+                            NULL_DATETIME)
+
+END = '2021-06-30'
+
+
+@pytest.fixture(scope='module')
+def data_dir(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('raw'))
+    make_practice(data_dir, n_patients=3000, end=END, seed=2)
+    return data_dir
+
+
+@pytest.fixture(scope='module')
+def merged(data_dir):
+    now = pd.Timestamp(END)
+    return {compact: Transform(compact=compact).run(data_dir, now=now) for compact in (False, True)}
+
+
+def test_parse_dates_masks_null_sentinel():
+    dates = pd.Series([NULL_DATETIME, '2021-06-29 10:30:00', None, 'not a date'])
+    parsed = parse_dates(dates, DATETIME_FORMAT, [NULL_DATETIME])
+    assert parsed.isna().tolist() == [True, False, True, True]
+
+
+def test_null_appointments_are_dropped():
+    appt = pd.DataFrame({'PatNum': [10, 10, 11], 'ProvNum': [1, 1, 2], 'AptStatus': [2, 2, 2],
+                         'AptDateTime': ['2021-01-04 09:00:00', NULL_DATETIME, '2021-02-01 14:00:00']})
+    cleaned = Transform().clean_appts(appt)
+    assert cleaned['PatNum'].tolist() == [10, 11]
+    assert cleaned['AptDateTime'].notna().all()
+
+
+def test_compact_dtypes_keep_features(merged):
+    default, compact = merged[False], merged[True]
+    seen_by = [col for col in default if col.startswith('seen_by_')]
+    assert seen_by and default[seen_by].to_numpy().any()
+    np.testing.assert_array_equal(compact[seen_by].to_numpy(), default[seen_by].to_numpy())
+    np.testing.assert_array_equal(compact['Gender'].to_numpy(), default['Gender'].to_numpy())
+    assert list(compact['FName']) == list(default['FName'])
+
+
+def test_compact_dtypes_keep_predictions(merged):
+    pytest.importorskip('sklearn')
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    default, compact = merged[False], merged[True]
+    features = model_features(default)
+    model = make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000))
+    model.fit(features, default['Recency'] > 400)
+    np.testing.assert_allclose(predict_in_chunks(model, model_features(compact)),
+                               predict_in_chunks(model, features), atol=1e-4)
+
+
+def test_cached_frames_match_uncached(data_dir, merged, tmp_path):
+    now = pd.Timestamp(END)
+    t = CachedTransform(str(tmp_path), compact=True)
+    miss = t.run(data_dir, now=now)
+    hit = t.run(data_dir, now=now)
+    pd.testing.assert_frame_equal(miss, merged[True])
+    pd.testing.assert_frame_equal(hit, miss)
+
+
+def test_contact_transform_compact(merged):
+    t = Transform(compact=True)
+    _, contact_list = t.data_split(merged[True])
+    top = t.contact_transform(contact_list, num_patients=10)
+    assert len(top) == 10
+    assert top['First Name'].str[0].str.isupper().all()
+
+
+def test_malformed_claims_lines_are_skipped(tmp_path):
+    counts = make_practice(str(tmp_path), n_patients=500, end=END, bad_line_rate=0.01, seed=4)
+    assert counts['bad_lines'] > 0
+    claims = Transform().read_claims(raw_paths(str(tmp_path))['claims'])
+    assert len(claims) == counts['claims']
+    # row labels still count the malformed lines, as CLAIMS_CORRECTIONS expects
+    assert claims.index[-1] == counts['claims'] + counts['bad_lines'] - 1
+    assert claims.index.is_unique and claims.index.is_monotonic_increasing
+
+
+def test_pay_aggregates_match_merges():
+    rng = np.random.default_rng(0)
+    dates = pd.Series(rng.choice(['2019-03-01', '2020-11-15', '2021-06-01'], 1000))
+    pay = pd.DataFrame({'PatNum': rng.integers(1, 120, 1000), 'PayDate': dates, 'PayAmt': rng.gamma(2, 40, 1000)})
+    claims = pd.DataFrame({'PatNum': rng.integers(50, 200, 500), 'DateReceived': dates[:500],
+                           'InsPayAmt': rng.gamma(2, 80, 500)})
+    grouped = pay_aggregates(pay, claims, now=pd.Timestamp(END), dated=False)
+
+    expected = pd.concat([pay.groupby('PatNum')['PayAmt'].sum(), claims.groupby('PatNum')['InsPayAmt'].sum()],
+                         axis=1).fillna(0)
+    np.testing.assert_array_equal(grouped.index, expected.index)
+    np.testing.assert_allclose(grouped[['PayAmt', 'InsPayAmt']].to_numpy(), expected.to_numpy())
+
+
+def test_contact_index_matches_full_sort():
+    rng = np.random.default_rng(0)
+    contact = pd.DataFrame({'PatNum': rng.permutation(2000) + 1, 'FName': rng.choice(['mary', 'JAMES'], 2000),
+                            'Recency': rng.integers(400, 720, 2000), 'Tenure': rng.integers(0, 5000, 2000),
+                            'Total': np.round(rng.gamma(2, 500, 2000), 2), 'Frequency': rng.integers(1, 40, 2000)})
+    expected = contact.assign(Score=contact['Recency'] - contact['Tenure'] / 30 - contact['Total'] / 70
+                              - contact['Frequency'] / 5).sort_values(['Score', 'PatNum']).iloc[:50]
+    shown = ContactIndex(contact).top(50, 30, 70, 5)
+    np.testing.assert_array_equal(shown['PatNum'].to_numpy(), expected['PatNum'].to_numpy())
+    np.testing.assert_allclose(shown['Score'].to_numpy(), expected['Score'].to_numpy())
+    assert shown['First Name'].isin(['Mary', 'James']).all()
+
+
+def test_model_features_leave_out_label_proxies(data_dir):
+    merged = Transform(lifetime_features=True).run(data_dir, now=pd.Timestamp(END))
+    features = model_features(merged)
+    assert 'Spend12m' in features and 'PayAmt' in features
+    assert not {'PatNum', 'FName', 'Recency', 'PayRecency', 'PayTenure'} & set(features.columns)